@@ -0,0 +1,87 @@
+import json
+import os
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    BATCH_CONCURRENCY = max(int(os.getenv("BATCH_CONCURRENCY", "4")), 1)
+except ValueError:
+    BATCH_CONCURRENCY = 4
+try:
+    BATCH_MAX_PROMPTS = max(int(os.getenv("BATCH_MAX_PROMPTS", "50")), 1)
+except ValueError:
+    BATCH_MAX_PROMPTS = 50
+
+BATCH_MAX_FILE_BYTES = 256 * 1024 # Largest prompt file accepted
+BATCH_MAX_PROMPT_CHARS = 4000 # Longest single prompt accepted
+
+
+class BatchInputError(ValueError):
+    """Raised when batch input can't be used, the message is shown to the user."""
+
+
+def parse_inline(text: str, separator: str) -> list[str]:
+    """Splits inline prompts on the separator, dropping empty ones."""
+    return [prompt.strip() for prompt in text.split(separator or "|") if prompt.strip()]
+
+
+def parse_file(filename: str, content: bytes) -> list[str]:
+    """
+    Reads prompts from an uploaded file. A .jsonl file has one JSON string or {"prompt": ...} object
+    per line, any other file is read as text with one prompt per line.
+    """
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BatchInputError("The file must be UTF-8 text.")
+
+    if not filename.lower().endswith(".jsonl"):
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    prompts = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            raise BatchInputError(f"Line {line_number} of the file is not valid JSON.")
+        if isinstance(item, dict):
+            item = item.get("prompt")
+        if not isinstance(item, str) or not item.strip():
+            raise BatchInputError(f'Line {line_number} of the file must be a string or an object with a "prompt".')
+        prompts.append(item.strip())
+    return prompts
+
+
+def validate_prompts(prompts: list[str]):
+    """Checks the prompt count and lengths against the batch limits."""
+    if not prompts:
+        raise BatchInputError("No prompts were found.")
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        raise BatchInputError(f"Too many prompts ({len(prompts)}), a batch can have at most {BATCH_MAX_PROMPTS}.")
+    for index, prompt in enumerate(prompts, start=1):
+        if len(prompt) > BATCH_MAX_PROMPT_CHARS:
+            raise BatchInputError(f"Prompt {index} is too long (max {BATCH_MAX_PROMPT_CHARS} characters).")
+
+
+def format_results(results: list[dict], as_jsonl: bool) -> bytes:
+    """
+    Combines batch results into one file. Each result has index, prompt, model, response and error keys.
+    JSONL input gets JSONL output so it can be processed further, otherwise the results are written as Markdown.
+    """
+    if as_jsonl:
+        return "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results).encode("utf-8")
+
+    sections = []
+    for result in results:
+        if result["error"]:
+            body = f"**Failed:** {result['error']}"
+        else:
+            body = result["response"]
+        model = f" ({result['model']})" if result["model"] else ""
+        quoted_prompt = "\n".join(f"> {line}" for line in result["prompt"].splitlines())
+        sections.append(f"## Prompt {result['index']}{model}\n\n{quoted_prompt}\n\n{body}\n")
+    return "\n".join(sections).encode("utf-8")
@@ -0,0 +1,155 @@
+import logging
+import logging.handlers
+import contextvars
+import queue
+import copy
+import atexit
+import random
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Request ID of the command currently being handled. Set by the command layer in main.py
+# and copied into executor threads so logs from Chat_GPT_Function can be tied to a command.
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# --- Settings (all optional, read from the environment) ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower() # "json" for JSON-lines, "text" for human readable
+LOG_FILE = os.getenv("LOG_FILE") # Optional file to write logs to (in addition to stderr)
+LOG_FULL_DEBUG = os.getenv("LOG_FULL_DEBUG", "0").lower() in ("1", "true", "yes")
+
+try:
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.05"))
+except ValueError:
+    LOG_PAYLOAD_SAMPLE_RATE = 0.05
+try:
+    LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+except ValueError:
+    LOG_PAYLOAD_MAX_CHARS = 2000
+
+# Standard LogRecord attributes, anything else on a record came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps the current request ID onto the record in the thread that logged it."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        return True
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps tracebacks in exc_text instead of folding them into the message."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats records as compact single-line JSON objects."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        # Include any structured fields passed with `extra=`
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """
+    Routes all logging through a queue so callers (including the event loop) never block on log I/O.
+    A background QueueListener thread does the actual formatting and writing.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if LOG_FORMAT == "text":
+        formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s:%(request_id)s: %(message)s')
+    else:
+        formatter = JsonLinesFormatter()
+
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queue_handler)
+    root.setLevel(logging.DEBUG if LOG_FULL_DEBUG else LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Stops the background listener, flushing any queued records."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def should_log_payload() -> bool:
+    """Decides whether to log a payload, based on LOG_PAYLOAD_SAMPLE_RATE (always True in full debug mode)."""
+    if LOG_FULL_DEBUG:
+        return True
+    return LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def log_payload(logger: logging.Logger, event: str, payload, sampled: bool | None = None, **fields):
+    """
+    Logs an upstream payload as a compact structured record.
+    Payloads are sampled (see should_log_payload) and capped at LOG_PAYLOAD_MAX_CHARS unless LOG_FULL_DEBUG is on,
+    in which case every payload is logged in full at DEBUG level.
+    Pass `sampled` to reuse a sampling decision made earlier for the same request.
+    """
+    if sampled is None:
+        sampled = should_log_payload()
+    if not sampled:
+        return
+
+    if isinstance(payload, str):
+        text = payload
+    else:
+        text = json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str)
+
+    size = len(text)
+    if not LOG_FULL_DEBUG and size > LOG_PAYLOAD_MAX_CHARS:
+        text = text[:LOG_PAYLOAD_MAX_CHARS]
+        fields["truncated"] = True
+
+    level = logging.DEBUG if LOG_FULL_DEBUG else logging.INFO
+    logger.log(level, event, extra={"event": event, "payload": text, "payload_chars": size, **fields})
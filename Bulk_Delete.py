@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+import discord
+
+logger = logging.getLogger(__name__)
+
+# Discord only bulk deletes messages younger than 14 days (with a margin for clock drift)
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_BATCH = 100 # Most messages per bulk delete request
+# Pause between single deletes of old messages. discord.py waits out 429s per route bucket, pacing
+# below the bucket's limit keeps us from hitting them at all (and from slowing other commands in the channel).
+SINGLE_DELETE_INTERVAL = 1.1
+PROGRESS_INTERVAL = 2.0 # Seconds between progress updates
+CLEAR_MAX_MESSAGES = 10000 # Most messages one /clear can delete
+CLEAR_SCAN_FACTOR = 10 # A filtered /clear checks at most this many messages per message it may delete
+
+
+class DeleteProgress:
+    """Counters for a running bulk delete, passed to the progress callback."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.scanned = 0
+        self.bulk_deleted = 0
+        self.single_deleted = 0
+        self.failed = 0
+        self.scan_limit_reached = False
+        self.started = time.monotonic()
+
+    @property
+    def deleted(self) -> int:
+        return self.bulk_deleted + self.single_deleted
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+async def bulk_delete(channel: discord.abc.Messageable, limit: int, check=None, before: datetime | None = None,
+                      after: datetime | None = None, cancelled: asyncio.Event | None = None, on_progress=None,
+                      max_scanned: int | None = None) -> DeleteProgress:
+    """
+    Deletes up to `limit` messages matching `check`, newest first.
+
+    Messages younger than 14 days are deleted in bulk requests of up to 100, older ones one at a time at a
+    paced rate. `on_progress` is awaited with a DeleteProgress at most every PROGRESS_INTERVAL seconds,
+    and setting `cancelled` stops the delete after the current request. `max_scanned` stops a filtered
+    delete from walking the whole channel history when few messages match.
+    """
+    progress = DeleteProgress(limit)
+    batch = []
+    last_progress = time.monotonic()
+
+    def bulk_cutoff() -> datetime:
+        return discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+
+    async def flush_batch():
+        nonlocal batch
+        # Checked again, a long scan can age batched messages past the bulk delete limit
+        cutoff = bulk_cutoff()
+        fresh = [message for message in batch if message.created_at > cutoff]
+        aged = [message for message in batch if message.created_at <= cutoff]
+        batch = []
+        if fresh:
+            try:
+                # delete_messages falls back to a single delete for a batch of one
+                await channel.delete_messages(fresh)
+                progress.bulk_deleted += len(fresh)
+            except discord.NotFound:
+                # Some were already deleted, delete the rest individually
+                for message in fresh:
+                    await delete_single(message)
+        for message in aged:
+            await delete_single(message)
+
+    async def delete_single(message: discord.Message):
+        try:
+            await message.delete()
+            progress.single_deleted += 1
+        except discord.NotFound:
+            pass # Already deleted
+        except discord.Forbidden:
+            raise # Missing permissions, no point trying the rest
+        except discord.HTTPException as e:
+            progress.failed += 1
+            logger.warning(f"Failed to delete message {message.id}: {e.status} {e.text}")
+        await asyncio.sleep(SINGLE_DELETE_INTERVAL)
+
+    async def report(force: bool = False):
+        nonlocal last_progress
+        if on_progress and (force or time.monotonic() - last_progress >= PROGRESS_INTERVAL):
+            last_progress = time.monotonic()
+            await on_progress(progress)
+
+    async for message in channel.history(limit=max_scanned, before=before, after=after, oldest_first=False):
+        if cancelled and cancelled.is_set():
+            break
+        progress.scanned += 1
+        if check and not check(message):
+            await report()
+            continue
+
+        if message.created_at > bulk_cutoff():
+            batch.append(message)
+            if len(batch) >= BULK_DELETE_BATCH:
+                await flush_batch()
+        else:
+            # History is newest first, so every message from here on is too old for bulk deletes
+            await flush_batch()
+            await delete_single(message)
+
+        await report()
+        if progress.deleted + len(batch) >= limit:
+            break
+    else: # History ran out, or the scan limit was reached
+        progress.scan_limit_reached = max_scanned is not None and progress.scanned >= max_scanned
+    if not (cancelled and cancelled.is_set()):
+        await flush_batch()
+    await report(force=True)
+    return progress
+
+
+def hours_ago(hours: int | None) -> datetime | None:
+    """Returns the UTC time `hours` ago, or None if no hours are given."""
+    if not hours:
+        return None
+    return datetime.now(timezone.utc) - timedelta(hours=hours)
@@ -1,18 +1,62 @@
+import openai
 from openai import OpenAI
 from dotenv import load_dotenv
-import os
 import requests
 import json
 import time
+import logging
+from Bot_Logging import log_payload, should_log_payload
+from Key_Pool import KeyPool, RateLimitExceeded, load_keys
 
 load_dotenv(override=True)
 
-gpt_api_key = os.getenv("GPT_API_KEY")
-openrouter_deepseek_api_key = os.getenv("OPENROUTER_DEEPSEEK_API_KEY")
+logger = logging.getLogger(__name__)
 
-def gpt(model: str, prompt: str, sys_prompt: str, temp: float,):
-    client = OpenAI(api_key= gpt_api_key)
-    response = client.chat.completions.create(
+# Key pools spread requests over every configured key (GPT_API_KEYS / OPENROUTER_DEEPSEEK_API_KEYS are
+# comma separated lists, GPT_API_KEY / OPENROUTER_DEEPSEEK_API_KEY still work for a single key)
+openai_key_pool = KeyPool("openai", load_keys("GPT_API_KEYS", "GPT_API_KEY"))
+openrouter_key_pool = KeyPool("openrouter", load_keys("OPENROUTER_DEEPSEEK_API_KEYS", "OPENROUTER_DEEPSEEK_API_KEY"),
+                              reset_headers="openrouter")
+
+DEEPSEEK_MODEL = "deepseek/deepseek-r1:free"
+KEY_ATTEMPTS = 3 # Keys tried for one request before giving up on 429s
+
+openai_clients = {} # API key -> client, reused so connections are kept alive
+
+
+def openai_call(call, tokens: int = 0):
+    """
+    Runs `call(client)` with a key from the OpenAI pool and returns the parsed response. `call` must use the
+    client's with_raw_response API so the rate limit headers can be read. 429s move on to another key.
+    """
+    for attempt in range(KEY_ATTEMPTS):
+        with openai_key_pool.lease(tokens) as lease:
+            client = openai_clients.get(lease.key)
+            if client is None:
+                # Retries are left to the pool, so a rate limited request moves to another key instead of waiting
+                client = openai_clients.setdefault(lease.key, OpenAI(api_key=lease.key, max_retries=0))
+            try:
+                raw_response = call(client)
+            except openai.RateLimitError as e:
+                lease.rate_limited(e.response.headers, quota=e.code == "insufficient_quota")
+                if attempt == KEY_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"OpenAI rate limited key {lease.state.name} (attempt {attempt + 1}/{KEY_ATTEMPTS}), trying another key.")
+                continue
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == KEY_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"OpenAI request failed (attempt {attempt + 1}/{KEY_ATTEMPTS}): {e}")
+                time.sleep(attempt + 1)
+                continue
+            lease.update(raw_response.headers)
+            return raw_response.parse()
+
+
+def gpt(model: str, prompt: str, sys_prompt: str, temp: float, usage: dict | None = None):
+    if usage is not None:
+        usage["model"] = model # Set before the call so failed calls can be attributed to the model
+    response = openai_call(lambda client: client.chat.completions.with_raw_response.create(
         model = model,
         messages=[
             {
@@ -27,58 +71,79 @@ def gpt(model: str, prompt: str, sys_prompt: str, temp: float,):
         temperature = temp,
         # max_tokens=64,
         top_p=1
-    )
+    ), tokens=(len(prompt) + len(sys_prompt)) // 4)
     output = response.choices[0].message.content.strip()
+    if usage is not None and response.usage:
+        # Report token usage back to the caller for the usage ledger
+        usage.update(
+            prompt_tokens = response.usage.prompt_tokens,
+            completion_tokens = response.usage.completion_tokens,
+        )
     return output
 
-def deepseek(prompt: str, sys_prompt: str, max_retries = 3):
+def deepseek(prompt: str, sys_prompt: str, max_retries = 3, usage: dict | None = None):
+    # Decide once per request whether payloads are logged, so sampled requests are logged in full
+    sampled = should_log_payload()
+    if usage is not None:
+        usage["model"] = DEEPSEEK_MODEL
     for attempt in range(max_retries):
         try:
-            response = requests.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {openrouter_deepseek_api_key}"
-                },
-                json={
-                    "model": "deepseek/deepseek-r1:free",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": sys_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "provider": {
-                        "order": ["Chutes", "Targon", "Azure"],
-                        "allow_fallbacks": False
+            with openrouter_key_pool.lease() as lease:
+                response = requests.post(
+                    url="https://openrouter.ai/api/v1/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {lease.key}"
                     },
-                    "include_reasoning": True
-                }
-            )
-            
+                    json={
+                        "model": DEEPSEEK_MODEL,
+                        "messages": [
+                            {
+                                "role": "system",
+                                "content": sys_prompt
+                            },
+                            {
+                                "role": "user",
+                                "content": prompt
+                            }
+                        ],
+                        "provider": {
+                            "order": ["Chutes", "Targon", "Azure"],
+                            "allow_fallbacks": False
+                        },
+                        "include_reasoning": True
+                    }
+                )
+                if response.status_code == 429:
+                    lease.rate_limited(response.headers)
+                elif response.ok:
+                    lease.update(response.headers)
+
+            if response.status_code == 429:
+                logger.warning(f"Attempt {attempt + 1}/{max_retries}: OpenRouter rate limited key {lease.state.name}.")
+                if attempt < max_retries - 1:
+                    continue # The pool moves on to another key, or waits for this one to reset
+                raise RateLimitExceeded(f"OpenRouter rate limited all {max_retries} attempts.")
+
             response_data = response.json()
-            print(f"API Response (Attempt {attempt + 1}):", json.dumps(response_data, indent=2))
+            log_payload(logger, "openrouter_response", response_data, sampled=sampled, attempt=attempt + 1, status=response.status_code)
             
             # Handle 500 errors
             if response.status_code == 500:
                 error_message = response_data.get("error", {}).get("message", "Unknown error")
-                print(f"Attempt {attempt + 1}/{max_retries}: Got server error: {error_message}")
+                logger.warning(f"Attempt {attempt + 1}/{max_retries}: Got server error: {error_message}")
                 if attempt < max_retries - 1:
                     wait_time = (attempt + 1) * 2
-                    print(f"Waiting {wait_time} seconds before retrying...")
+                    logger.info(f"Waiting {wait_time} seconds before retrying...")
                     time.sleep(wait_time)
                     continue
                 raise Exception(f"Failed after {max_retries} attempts. Last error: {error_message}")
             
             # Check for missing or empty choices
             if not response_data.get("choices"):
-                print("No choices in response")
+                logger.warning("No choices in response")
                 if attempt < max_retries - 1:
                     wait_time = (attempt + 1) * 2
-                    print(f"Waiting {wait_time} seconds before retrying...")
+                    logger.info(f"Waiting {wait_time} seconds before retrying...")
                     time.sleep(wait_time)
                     continue
                 raise Exception("No choices in API response after all retries")
@@ -88,10 +153,10 @@ def deepseek(prompt: str, sys_prompt: str, max_retries = 3):
             
             # Handle empty or missing content
             if not content:
-                print("Empty or missing content in response")
+                logger.warning("Empty or missing content in response")
                 if attempt < max_retries - 1:
                     wait_time = (attempt + 1) * 2
-                    print(f"Waiting {wait_time} seconds before retrying...")
+                    logger.info(f"Waiting {wait_time} seconds before retrying...")
                     time.sleep(wait_time)
                     continue
                 raise Exception("Empty or missing content in response after all retries")
@@ -99,25 +164,33 @@ def deepseek(prompt: str, sys_prompt: str, max_retries = 3):
             # Check for reasoning
             reasoning = message.get("reasoning")
             if reasoning:
-                print("Reasoning:", reasoning.strip())
+                log_payload(logger, "deepseek_reasoning", reasoning.strip(), sampled=sampled)
+
+            # Report token usage back to the caller for the usage ledger
+            if usage is not None:
+                usage_data = response_data.get("usage") or {}
+                usage.update(
+                    prompt_tokens = usage_data.get("prompt_tokens", 0),
+                    completion_tokens = usage_data.get("completion_tokens", 0),
+                )
             
             return content.strip()
             
         except requests.exceptions.RequestException as e:
-            print(f"Request error on attempt {attempt + 1}: {str(e)}")
+            logger.warning(f"Request error on attempt {attempt + 1}: {str(e)}")
             if attempt < max_retries - 1:
                 wait_time = (attempt + 1) * 2
-                print(f"Waiting {wait_time} seconds before retrying...")
+                logger.info(f"Waiting {wait_time} seconds before retrying...")
                 time.sleep(wait_time)
                 continue
             raise Exception(f"Request failed after {max_retries} attempts: {str(e)}")
             
         except json.JSONDecodeError as e:
-            print(f"JSON decode error on attempt {attempt + 1}: {str(e)}")
-            print(f"Raw response: {response.text}")
+            logger.warning(f"JSON decode error on attempt {attempt + 1}: {str(e)}")
+            log_payload(logger, "openrouter_raw_response", response.text, sampled=True, attempt=attempt + 1)
             if attempt < max_retries - 1:
                 wait_time = (attempt + 1) * 2
-                print(f"Waiting {wait_time} seconds before retrying...")
+                logger.info(f"Waiting {wait_time} seconds before retrying...")
                 time.sleep(wait_time)
                 continue
             raise Exception(f"Invalid JSON response after {max_retries} attempts")
@@ -125,26 +198,28 @@ def deepseek(prompt: str, sys_prompt: str, max_retries = 3):
     raise Exception("All retry attempts failed")
 
 
-def dalle3(prompt: str, quality: str, size: str, style: str):
-    client = OpenAI(api_key= gpt_api_key)
-    response = client.images.generate(
+def dalle3(prompt: str, quality: str, size: str, style: str, usage: dict | None = None):
+    response = openai_call(lambda client: client.images.with_raw_response.generate(
         model = "dall-e-3",
         prompt = prompt,
         size = size,
         quality = quality,
         style = style,
         n=1,
-        )
+        ))
     image_url = response.data[0].url
+    if usage is not None:
+        usage.update(model = "dall-e-3", images = 1)
     return image_url
 
-def dalle2(prompt: str, size: str):
-    client = OpenAI(api_key= gpt_api_key)
-    response = client.images.generate(
+def dalle2(prompt: str, size: str, usage: dict | None = None):
+    response = openai_call(lambda client: client.images.with_raw_response.generate(
         model = "dall-e-2",
         prompt = prompt,
         size = size,
         n=1,
-        )
+        ))
     image_url = response.data[0].url
+    if usage is not None:
+        usage.update(model = "dall-e-2", images = 1)
     return image_url
\ No newline at end of file
@@ -0,0 +1,119 @@
+import ast
+import os
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    CODE_CHUNK_TOKENS = max(int(os.getenv("CODE_CHUNK_TOKENS", "2500")), 200)
+except ValueError:
+    CODE_CHUNK_TOKENS = 2500
+try:
+    CODE_MAX_CHUNKS = max(int(os.getenv("CODE_MAX_CHUNKS", "12")), 1)
+except ValueError:
+    CODE_MAX_CHUNKS = 12
+try:
+    # Every part at once by default, so a file takes about as long as its slowest part (the key pool still throttles)
+    CODE_CHUNK_CONCURRENCY = max(int(os.getenv("CODE_CHUNK_CONCURRENCY", str(CODE_MAX_CHUNKS))), 1)
+except ValueError:
+    CODE_CHUNK_CONCURRENCY = CODE_MAX_CHUNKS
+
+CODE_MAX_FILE_BYTES = 512 * 1024 # Largest code file downloaded
+CHARS_PER_TOKEN = 4 # Rough estimate, same as the budget checks in main.py
+
+# Lines that continue the previous block even when they aren't indented
+_CONTINUATION_PREFIXES = ("}", ")", "]", "else", "elif", "except", "finally", "catch", "end", "#", "//", "*", "/*")
+_OPENERS, _CLOSERS = "{([", "})]"
+
+
+class CodeChunk:
+    """A piece of a file, with 1-based line numbers."""
+    def __init__(self, start_line: int, end_line: int, text: str):
+        self.start_line = start_line
+        self.end_line = end_line
+        self.text = text
+
+
+def _python_boundaries(text: str) -> list[int] | None:
+    """Returns the 0-based start line of each top-level statement, or None if the file isn't valid Python."""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    starts = []
+    for node in tree.body:
+        decorators = getattr(node, "decorator_list", [])
+        starts.append(min([node.lineno] + [decorator.lineno for decorator in decorators]) - 1)
+    return starts
+
+
+def _heuristic_boundaries(lines: list[str]) -> list[int]:
+    """
+    Returns the 0-based lines where a new top-level block starts: unindented lines outside any brackets
+    that don't continue the previous block (closing braces, else branches, decorated definitions, comments).
+    """
+    starts = [0]
+    depth = 0
+    previous = ""
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if (index and stripped and depth <= 0 and line[0] not in " \t"
+                and not stripped.startswith(_CONTINUATION_PREFIXES) and not previous.startswith("@")):
+            starts.append(index)
+        depth += sum(line.count(char) for char in _OPENERS) - sum(line.count(char) for char in _CLOSERS)
+        if stripped:
+            previous = stripped
+    return starts
+
+
+def _line_pieces(lines: list[str], first_line: int, max_chars: int) -> list[tuple[int, str]]:
+    """Returns (0-based line number, text) pieces of a block, cutting lines longer than max_chars."""
+    pieces = []
+    for offset, line in enumerate(lines):
+        pieces.extend((first_line + offset, line[i:i + max_chars]) for i in range(0, len(line), max_chars))
+    return pieces
+
+
+def chunk_code(text: str, filename: str = "", max_tokens: int = CODE_CHUNK_TOKENS) -> list[CodeChunk]:
+    """
+    Splits code into chunks of at most max_tokens (estimated), keeping top-level definitions together.
+    Valid Python is split on its top-level statements, other code on unindented lines outside brackets.
+    A definition too large for one chunk is split between lines, and its pieces share chunks with the
+    code around it, so no chunk is left with just a few lines.
+    """
+    lines = text.splitlines(keepends=True)
+    if not lines:
+        return []
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    starts = _python_boundaries(text) if filename.endswith(".py") else None
+    if not starts:
+        starts = _heuristic_boundaries(lines)
+    starts = sorted(set([0] + starts))
+    blocks = [(start, lines[start:end]) for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+    chunks, current, size = [], [], 0 # current holds (0-based line number, text) pieces
+
+    def flush():
+        nonlocal current, size
+        chunks.append(CodeChunk(current[0][0] + 1, current[-1][0] + 1, "".join(text for _, text in current)))
+        current, size = [], 0
+
+    for start, block in blocks:
+        block_size = sum(len(line) for line in block)
+        if block_size <= max_chars:
+            # Pack whole blocks into chunks up to the size limit
+            if current and size + block_size > max_chars:
+                flush()
+            current.extend((start + offset, line) for offset, line in enumerate(block))
+            size += block_size
+            continue
+        # Too large on its own: pack it line by line, continuing the current chunk
+        for line_number, piece in _line_pieces(block, start, max_chars):
+            if current and size + len(piece) > max_chars:
+                flush()
+            current.append((line_number, piece))
+            size += len(piece)
+    if current:
+        flush()
+    return chunks
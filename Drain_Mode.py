@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "60"))
+except ValueError:
+    DRAIN_TIMEOUT_SECONDS = 60
+DRAIN_CHECKPOINT_DIR = os.getenv("DRAIN_CHECKPOINT_DIR", "drain_checkpoints") # Shared by all instances
+
+# Interaction tokens are valid for 15 minutes, older jobs can't be answered anymore
+INTERACTION_TOKEN_LIFETIME = 14 * 60
+
+
+class JobHandedOff(Exception):
+    """Raised in place of a job's API call when the job was already handed off to another instance."""
+
+
+class DrainController:
+    """
+    Tracks in-flight API jobs so the bot can restart without abandoning them.
+
+    While draining, new jobs are refused. At the deadline, jobs whose API call hasn't started yet are
+    cancelled here and written to a checkpoint file in DRAIN_CHECKPOINT_DIR, which another instance claims
+    (by renaming it) and completes by sending the result through the interaction's followup webhook.
+    Jobs whose API call is already running are never handed off (that would pay for them twice), the
+    draining instance waits for them and answers them itself.
+    """
+    def __init__(self, checkpoint_dir: str = DRAIN_CHECKPOINT_DIR):
+        self.checkpoint_dir = checkpoint_dir
+        self.draining = False
+        self.jobs = {} # interaction ID -> job description (see begin)
+        self._tasks = {} # interaction ID -> task answering the job
+        self._lock = threading.Lock() # Guards the "started" / "handed_off" flags, set from executor threads
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def begin(self, job_id: int, job: dict) -> bool:
+        """
+        Registers an in-flight job for the current task. Returns False if the bot is draining and the job
+        should be refused. `job` must be JSON serializable and describe how to redo the work (see main.py's
+        resume_job). Jobs with "resumable" set to False are waited for while draining but never checkpointed.
+        """
+        if self.draining:
+            return False
+        job.setdefault("created", time.time()) # Kept when a checkpointed job is resumed, the token lifetime still runs
+        self.jobs[job_id] = job
+        self._tasks[job_id] = asyncio.current_task()
+        self._idle.clear()
+        return True
+
+    def end(self, job_id: int):
+        """Marks a job as finished."""
+        self.jobs.pop(job_id, None)
+        self._tasks.pop(job_id, None)
+        if not self.jobs:
+            self._idle.set()
+
+    def run_job(self, job_id: int, func, *args, **kwargs):
+        """
+        Runs a job's blocking API call (in an executor thread), marking the job as started so it's no
+        longer handed off. Raises JobHandedOff if another instance has already taken the job over.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                if job.get("handed_off"):
+                    raise JobHandedOff(f"Job {job_id} was handed off to another instance.")
+                job["started"] = True
+        return func(*args, **kwargs)
+
+    def start(self):
+        """Stops admitting new jobs."""
+        self.draining = True
+        logger.warning(f"Drain mode started with {len(self.jobs)} in-flight jobs.")
+
+    async def wait_idle(self, timeout: float = DRAIN_TIMEOUT_SECONDS) -> bool:
+        """Waits until all in-flight jobs have finished. Returns False if the timeout was reached first."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def hand_off(self) -> list[dict]:
+        """
+        Takes the resumable jobs whose API call hasn't started yet away from this instance: their tasks are
+        cancelled so this instance never answers them. Returns the jobs, to be written with checkpoint().
+        """
+        now = time.time()
+        with self._lock:
+            jobs = {
+                job_id: job for job_id, job in self.jobs.items()
+                if job.get("resumable", True) and not job.get("started")
+                and now - job["created"] < INTERACTION_TOKEN_LIFETIME
+            }
+            for job in jobs.values():
+                job["handed_off"] = True
+        for job_id in jobs:
+            task = self._tasks.get(job_id)
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+            self.end(job_id)
+        return list(jobs.values())
+
+    def checkpoint(self, jobs: list[dict]):
+        """
+        Writes handed off jobs to a checkpoint file for another instance to complete. The file holds the
+        interaction tokens, so it's only readable by the bot's user.
+        """
+        if not jobs:
+            return
+        os.makedirs(self.checkpoint_dir, mode=0o700, exist_ok=True)
+        name = f"{int(time.time() * 1000)}-{os.getpid()}"
+        tmp_path = os.path.join(self.checkpoint_dir, name + ".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump([
+                {key: value for key, value in job.items() if key not in ("started", "handed_off")} for job in jobs
+            ], f, separators=(",", ":"))
+        os.replace(tmp_path, os.path.join(self.checkpoint_dir, name + ".json"))
+        logger.warning(f"Checkpointed {len(jobs)} unstarted jobs to {self.checkpoint_dir}.")
+
+    def claim_checkpoints(self) -> list[dict]:
+        """
+        Claims checkpoint files left by a draining instance and returns their jobs that can still be answered.
+        Files are claimed by renaming, so each job is picked up by only one instance.
+        """
+        if self.draining or not os.path.isdir(self.checkpoint_dir):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(self.checkpoint_dir)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.checkpoint_dir, name)
+            claimed_path = f"{path}.claimed-{os.getpid()}"
+            try:
+                os.rename(path, claimed_path)
+            except OSError:
+                continue # Claimed by another instance
+            try:
+                with open(claimed_path, encoding="utf-8") as f:
+                    file_jobs = json.load(f)
+                os.remove(claimed_path)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"Could not read drain checkpoint {claimed_path}: {e}")
+                continue
+            for job in file_jobs:
+                if time.time() - job.get("created", 0) < INTERACTION_TOKEN_LIFETIME:
+                    jobs.append(job)
+                else:
+                    logger.warning(f"Dropping checkpointed job for /{job.get('command')}: interaction token expired.")
+        if jobs:
+            logger.info(f"Claimed {len(jobs)} checkpointed jobs from a previous instance.")
+        return jobs
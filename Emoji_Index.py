@@ -0,0 +1,196 @@
+import threading
+import logging
+import json
+import os
+import re
+import time
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# --- Settings (all optional, read from the environment) ---
+EMOJI_SEED_PATH = os.getenv("EMOJI_SEED_PATH", "Emoji_Seed.json") # Bundled word to emoji table
+EMOJI_INDEX_PATH = os.getenv("EMOJI_INDEX_PATH", "emoji_index.tsv") # Words learned from model responses
+try:
+    EMOJI_INDEX_MAX_WORDS = int(os.getenv("EMOJI_INDEX_MAX_WORDS", "5000"))
+except ValueError:
+    EMOJI_INDEX_MAX_WORDS = 5000
+try:
+    # Times the model must agree on a word's emoji before it is answered locally
+    EMOJI_INDEX_MIN_VOTES = int(os.getenv("EMOJI_INDEX_MIN_VOTES", "2"))
+except ValueError:
+    EMOJI_INDEX_MIN_VOTES = 2
+
+_WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*") # Words, ignoring punctuation (keeps "don't")
+_TEXT_PATTERN = re.compile(r"[A-Za-z0-9]") # Plain text in a response means it is not emoji only
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits a message into lowercase words, ignoring punctuation."""
+    return _WORD_PATTERN.findall(text.lower())
+
+
+def _joins_previous(char: str) -> bool:
+    """True if a character extends the previous emoji rather than starting a new one."""
+    code = ord(char)
+    return (
+        code == 0x200D # Zero width joiner
+        or 0xFE00 <= code <= 0xFE0F # Variation selectors
+        or 0x1F3FB <= code <= 0x1F3FF # Skin tones
+        or code == 0x20E3 # Keycap
+        or 0xE0020 <= code <= 0xE007F # Tag sequences (subdivision flags)
+    )
+
+
+def split_emojis(text: str) -> list[str]:
+    """Splits a run of emojis into individual emojis, keeping ZWJ sequences, modifiers and flags together."""
+    emojis = []
+    current = ""
+    for char in text:
+        code = ord(char)
+        if char.isspace():
+            if current:
+                emojis.append(current)
+            current = ""
+        elif current and (_joins_previous(char) or current.endswith("\u200d")):
+            current += char
+        elif (current and 0x1F1E6 <= code <= 0x1F1FF and len(current) == 1
+              and 0x1F1E6 <= ord(current) <= 0x1F1FF):
+            current += char # Second regional indicator of a flag
+        else:
+            if current:
+                emojis.append(current)
+            current = char
+    if current:
+        emojis.append(current)
+    return emojis
+
+
+class EmojiIndex:
+    """
+    Local word to emoji index for /gpt_text_to_emoji.
+
+    Seeded from a bundled table and extended by learning from model responses: when a response has
+    one emoji (or one space separated group) per word, each word gets a vote for its emoji. Learned
+    words are stored on disk as "word<TAB>emoji<TAB>votes<TAB>last seen" lines and capped at
+    EMOJI_INDEX_MAX_WORDS. Eviction drops words with fewer than min_votes votes first, least recently
+    seen first, so newly learned words replace stale ones instead of being evicted straight away.
+    """
+    def __init__(self, seed_path: str = EMOJI_SEED_PATH, index_path: str = EMOJI_INDEX_PATH,
+                 max_words: int = EMOJI_INDEX_MAX_WORDS, min_votes: int = EMOJI_INDEX_MIN_VOTES):
+        self.index_path = index_path
+        self.max_words = max_words
+        self.min_votes = max(min_votes, 1)
+        self.seed = {}
+        self.learned = {} # word -> [emoji, votes, last seen (Unix time)]
+        self.pending_changes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load(seed_path)
+
+    def _load(self, seed_path: str):
+        try:
+            with open(seed_path, encoding="utf-8") as f:
+                self.seed = {word.lower(): emoji for word, emoji in json.load(f).items()}
+        except (OSError, json.JSONDecodeError, AttributeError) as e:
+            logger.warning(f"Could not load emoji seed table from {seed_path}: {e}")
+
+        if not os.path.exists(self.index_path):
+            return
+        now = int(time.time())
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) not in (3, 4) or not all(part.isdigit() for part in parts[2:]):
+                        continue
+                    # Files written before last seen times were tracked count as seen now
+                    last_seen = int(parts[3]) if len(parts) == 4 else now
+                    self.learned[parts[0]] = [parts[1], int(parts[2]), last_seen]
+        except OSError as e:
+            logger.warning(f"Could not load learned emoji index from {self.index_path}: {e}")
+        logger.info(f"Emoji index loaded: {len(self.seed)} seed words, {len(self.learned)} learned words.")
+
+    def _emoji_for(self, word: str, now: int) -> str | None:
+        if word in self.seed:
+            return self.seed[word]
+        entry = self.learned.get(word)
+        if entry and entry[1] >= self.min_votes:
+            entry[2] = now
+            return entry[0]
+        return None
+
+    def lookup(self, text: str) -> str | None:
+        """Returns the emoji translation if every word in the text is known, otherwise None."""
+        words = tokenize(text)
+        if not words:
+            return None
+        emojis = []
+        now = int(time.time())
+        with self._lock:
+            for word in words:
+                emoji = self._emoji_for(word, now)
+                if emoji is None:
+                    self.misses += 1
+                    return None
+                emojis.append(emoji)
+            self.hits += 1
+        return " ".join(emojis)
+
+    def learn(self, text: str, response: str):
+        """Learns word to emoji mappings from a model response, if its emojis line up with the words."""
+        words = tokenize(text)
+        if not words or _TEXT_PATTERN.search(response):
+            return
+        groups = response.split()
+        if len(groups) != len(words):
+            groups = split_emojis(response)
+            if len(groups) != len(words):
+                return # Can't tell which emoji belongs to which word
+
+        now = int(time.time())
+        with self._lock:
+            for word, emoji in zip(words, groups):
+                if word in self.seed:
+                    continue
+                entry = self.learned.get(word)
+                if entry is None:
+                    self.learned[word] = [emoji, 1, now]
+                elif entry[0] == emoji:
+                    entry[1] += 1
+                    entry[2] = now
+                else:
+                    # Majority vote: a different answer costs a vote, and replaces the emoji once none are left
+                    entry[1] -= 1
+                    entry[2] = now
+                    if entry[1] <= 0:
+                        self.learned[word] = [emoji, 1, now]
+                self.pending_changes += 1
+
+            if len(self.learned) > self.max_words:
+                # Evict down to 90% of the cap so eviction doesn't run on every learn. Confirmed words are
+                # kept over unconfirmed ones, and within each group the most recently seen are kept.
+                keep = sorted(
+                    self.learned.items(), key=lambda item: (item[1][1] >= self.min_votes, item[1][2]), reverse=True
+                )[:int(self.max_words * 0.9)]
+                self.learned = dict(keep)
+
+    def save(self):
+        """Writes learned words to disk (atomically)."""
+        with self._lock:
+            if not self.pending_changes:
+                return
+            lines = [
+                f"{word}\t{emoji}\t{votes}\t{last_seen}\n" for word, (emoji, votes, last_seen) in self.learned.items()
+            ]
+            self.pending_changes = 0
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Failed to save emoji index to {self.index_path}: {e}")
@@ -0,0 +1,126 @@
+"""
+Image post-processing for DALL-E results. The functions here run in a process pool (see start_pool),
+so they must stay importable on their own and only take and return picklable values.
+"""
+import concurrent.futures
+import multiprocessing
+import io
+import os
+import time
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# Quality presets: encoder quality for the full size variants, and the thumbnail's longest side in pixels
+QUALITY_PRESETS = {
+    "high": {"quality": 90, "thumbnail_px": 768},
+    "balanced": {"quality": 80, "thumbnail_px": 512},
+    "small": {"quality": 65, "thumbnail_px": 384},
+}
+MIN_QUALITY = 40 # Lowest quality tried before downscaling to meet the size target
+THUMBNAIL_QUALITY = 75
+
+# --- Settings (all optional, read from the environment) ---
+IMAGE_QUALITY_PRESET = os.getenv("IMAGE_QUALITY_PRESET", "balanced")
+if IMAGE_QUALITY_PRESET not in QUALITY_PRESETS:
+    IMAGE_QUALITY_PRESET = "balanced"
+try:
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+except ValueError:
+    IMAGE_WORKERS = 2
+try:
+    IMAGE_UPLOAD_TARGET_BYTES = int(os.getenv("IMAGE_UPLOAD_TARGET_BYTES", str(2 * 1024 * 1024)))
+except ValueError:
+    IMAGE_UPLOAD_TARGET_BYTES = 2 * 1024 * 1024
+
+
+def _parse_guild_targets(value: str) -> dict[int, int]:
+    """Parses IMAGE_GUILD_UPLOAD_TARGETS, e.g. "123456789:1000000,987654321:4000000"."""
+    targets = {}
+    for item in value.split(","):
+        guild_id, _, target = item.strip().partition(":")
+        if guild_id.isdigit() and target.isdigit():
+            targets[int(guild_id)] = int(target)
+    return targets
+
+
+# Per-guild upload size targets in bytes, overriding IMAGE_UPLOAD_TARGET_BYTES
+IMAGE_GUILD_UPLOAD_TARGETS = _parse_guild_targets(os.getenv("IMAGE_GUILD_UPLOAD_TARGETS", ""))
+
+
+def upload_target(guild_id: int | None, guild_limit: int | None) -> int:
+    """Returns the upload size target for a guild, never above the guild's own upload limit."""
+    target = IMAGE_GUILD_UPLOAD_TARGETS.get(guild_id, IMAGE_UPLOAD_TARGET_BYTES)
+    if guild_limit:
+        target = min(target, guild_limit)
+    return target
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.convert("RGB").save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, "WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def _encode_to_target(image: Image.Image, image_format: str, quality: int, target_bytes: int) -> tuple[bytes, int, tuple]:
+    """Encodes at the preset quality, lowering quality and then scaling down until the result fits the target."""
+    while True:
+        data = _encode(image, image_format, quality)
+        if len(data) <= target_bytes:
+            return data, quality, image.size
+        if quality > MIN_QUALITY:
+            quality = max(quality - 10, MIN_QUALITY)
+        elif min(image.size) > 256:
+            image = image.resize((int(image.width * 0.8), int(image.height * 0.8)), Image.LANCZOS)
+        else:
+            return data, quality, image.size # Can't get smaller, upload as is
+
+
+def start_pool(workers: int = IMAGE_WORKERS) -> concurrent.futures.ProcessPoolExecutor | None:
+    """
+    Starts the image worker processes, or returns None if post-processing is turned off.
+    Call this before any threads are started: workers are forked (where available) so they don't re-run
+    the bot's startup code, and forking a process while other threads hold locks can deadlock the child.
+    """
+    if workers <= 0:
+        return None
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    pool.submit(os.getpid).result() # Forks all workers now rather than on the first image
+    return pool
+
+
+def process_image(original: bytes, preset: str, target_bytes: int) -> dict:
+    """
+    Produces size-optimized WebP and JPEG variants plus a WebP thumbnail of a downloaded image.
+    Returns the encoded bytes with sizes and timings. Runs in a worker process.
+    """
+    start = time.perf_counter()
+    settings = QUALITY_PRESETS.get(preset, QUALITY_PRESETS["balanced"])
+    image = Image.open(io.BytesIO(original))
+    image.load()
+    original_format = image.format
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    variants = {}
+    for image_format in ("WEBP", "JPEG"):
+        data, quality, size = _encode_to_target(image, image_format, settings["quality"], target_bytes)
+        variants[image_format.lower()] = {"data": data, "quality": quality, "size": size}
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((settings["thumbnail_px"], settings["thumbnail_px"]), Image.LANCZOS)
+    thumbnail_data = _encode(thumbnail, "WEBP", THUMBNAIL_QUALITY)
+
+    return {
+        "original_bytes": len(original),
+        "original_format": original_format,
+        "original_size": image.size,
+        "variants": variants,
+        "thumbnail": thumbnail_data,
+        "encode_ms": round((time.perf_counter() - start) * 1000),
+    }
@@ -0,0 +1,247 @@
+import threading
+import logging
+import contextlib
+import re
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    KEY_POOL_CONCURRENCY_PER_KEY = max(int(os.getenv("KEY_POOL_CONCURRENCY_PER_KEY", "8")), 1)
+except ValueError:
+    KEY_POOL_CONCURRENCY_PER_KEY = 8
+try:
+    KEY_POOL_WAIT_SECONDS = float(os.getenv("KEY_POOL_WAIT_SECONDS", "60"))
+except ValueError:
+    KEY_POOL_WAIT_SECONDS = 60
+try:
+    # Threads that run upstream API calls (see main.py's run_api). A call waiting for a key holds one of them,
+    # so waits never starve the default executor used for disk writes.
+    API_WORKERS = max(int(os.getenv("API_WORKERS", "32")), 1)
+except ValueError:
+    API_WORKERS = 32
+
+# How long a key is sidelined after a 429 without a retry-after or reset header, and after running out of quota
+DEFAULT_SIDELINE_SECONDS = 20
+QUOTA_SIDELINE_SECONDS = 600
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when no key becomes available in time, or a provider keeps rate limiting every key."""
+
+
+def load_keys(pool_var: str, single_var: str) -> list[str]:
+    """Reads a comma separated key list, falling back to the single key variable."""
+    keys = [key.strip() for key in os.getenv(pool_var, "").split(",") if key.strip()]
+    if not keys and os.getenv(single_var):
+        keys = [os.getenv(single_var).strip()]
+    return list(dict.fromkeys(keys)) # Drop duplicates, keep order
+
+
+def parse_duration(value: str | None) -> float | None:
+    """Parses OpenAI reset durations such as "20ms", "1s" or "6m0s" into seconds."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _int_header(headers, name: str) -> int | None:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyState:
+    """Rate limit state of one API key, as last reported by the provider's response headers."""
+    def __init__(self, key: str):
+        self.key = key
+        self.name = f"...{key[-4:]}" # Safe to log
+        self.remaining_requests = None # None until the provider has reported it
+        self.remaining_tokens = None
+        self.reset_at = 0.0 # Monotonic time when the remaining counts reset
+        self.sidelined_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+
+    def usable(self, tokens: int, now: float) -> bool:
+        if now < self.sidelined_until:
+            return False
+        if now >= self.reset_at:
+            self.remaining_requests = self.remaining_tokens = None # Window has reset, counts are stale
+            return True
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            return False
+        return self.remaining_tokens is None or self.remaining_tokens >= tokens
+
+
+class KeyLease:
+    """A key checked out from a pool. Report the response headers (or a 429) before the lease ends."""
+    def __init__(self, pool: "KeyPool", state: KeyState, tokens: int):
+        self.pool = pool
+        self.state = state
+        self.tokens = tokens
+        self.key = state.key
+        self.outcome = None # "ok", "limited" or None (failed for another reason)
+
+    def update(self, headers):
+        """Records the rate limit headers of a successful response."""
+        self.outcome = "ok"
+        self.pool._apply_headers(self.state, headers)
+
+    def rate_limited(self, headers=None, quota: bool = False):
+        """Records a 429. `quota` means the key is out of credit rather than over a rate limit."""
+        self.outcome = "limited"
+        self.pool._sideline(self.state, headers or {}, quota)
+
+
+class KeyPool:
+    """
+    Spreads requests for one provider across several API keys.
+
+    Each request leases the key with the most remaining requests and tokens (as reported by the provider's
+    rate limit headers), skipping keys that are exhausted until their window resets. A 429 sidelines the key
+    until its reset time and halves the pool's concurrency limit, every success raises the limit a little
+    (AIMD), so the pool settles just under what the provider allows.
+    """
+    def __init__(self, provider: str, keys: list[str], concurrency_per_key: int = KEY_POOL_CONCURRENCY_PER_KEY,
+                 reset_headers: str = "openai"):
+        self.provider = provider
+        self.keys = [KeyState(key) for key in keys]
+        self.max_limit = max(concurrency_per_key * len(keys), 1)
+        self.limit = float(self.max_limit) # AIMD concurrency window
+        self.in_flight = 0
+        self.reset_headers = reset_headers
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def lease(self, tokens: int = 0, timeout: float = KEY_POOL_WAIT_SECONDS):
+        """Checks out a key for one request, waiting up to `timeout` for one to become available."""
+        lease = self._acquire(tokens, timeout)
+        try:
+            yield lease
+        finally:
+            self._release(lease)
+
+    def _acquire(self, tokens: int, timeout: float) -> KeyLease:
+        if not self.keys:
+            raise RateLimitExceeded(f"No {self.provider} API keys are configured.")
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                state = None
+                if self.in_flight < int(self.limit):
+                    usable = [key for key in self.keys if key.usable(tokens, now)]
+                    if usable:
+                        # Most headroom first (unknown counts count as plenty), then the least busy key
+                        state = max(usable, key=lambda key: (
+                            key.remaining_requests if key.remaining_requests is not None else float("inf"),
+                            key.remaining_tokens if key.remaining_tokens is not None else float("inf"),
+                            -key.in_flight,
+                        ))
+                if state:
+                    break
+                if now >= deadline:
+                    raise RateLimitExceeded(f"All {self.provider} API keys are rate limited, try again later.")
+                # Wake up when a request finishes, a key comes back, or the deadline passes
+                wake_at = min([deadline] + [key.sidelined_until for key in self.keys if key.sidelined_until > now]
+                              + [key.reset_at for key in self.keys if key.reset_at > now])
+                self._condition.wait(max(wake_at - now, 0.01))
+
+            self.in_flight += 1
+            state.in_flight += 1
+            state.requests += 1
+            # Count this request against the key until the provider reports fresh numbers
+            if state.remaining_requests is not None:
+                state.remaining_requests -= 1
+            if state.remaining_tokens is not None:
+                state.remaining_tokens -= tokens
+            return KeyLease(self, state, tokens)
+
+    def _release(self, lease: KeyLease):
+        with self._condition:
+            self.in_flight -= 1
+            lease.state.in_flight -= 1
+            if lease.outcome == "ok":
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit) # Additive increase
+            elif lease.outcome == "limited":
+                self.limit = max(self.limit / 2, 1.0) # Multiplicative decrease
+            self._condition.notify_all()
+
+    def _parse_headers(self, headers) -> tuple[int | None, int | None, float | None]:
+        """Returns (remaining requests, remaining tokens, seconds until reset) from the provider's rate limit headers."""
+        if self.reset_headers == "openrouter":
+            # OpenRouter reports one request counter, with the reset as a Unix timestamp in milliseconds
+            remaining_requests = _int_header(headers, "x-ratelimit-remaining")
+            remaining_tokens = None
+            reset_ms = _int_header(headers, "x-ratelimit-reset")
+            reset_in = max(reset_ms / 1000 - time.time(), 0) if reset_ms else None
+        else:
+            remaining_requests = _int_header(headers, "x-ratelimit-remaining-requests")
+            remaining_tokens = _int_header(headers, "x-ratelimit-remaining-tokens")
+            resets = [parse_duration(headers.get("x-ratelimit-reset-requests")),
+                      parse_duration(headers.get("x-ratelimit-reset-tokens"))]
+            resets = [reset for reset in resets if reset is not None]
+            reset_in = max(resets) if resets else None
+        return remaining_requests, remaining_tokens, reset_in
+
+    def _apply_headers(self, state: KeyState, headers):
+        remaining_requests, remaining_tokens, reset_in = self._parse_headers(headers)
+        with self._condition:
+            if remaining_requests is not None:
+                state.remaining_requests = remaining_requests
+            if remaining_tokens is not None:
+                state.remaining_tokens = remaining_tokens
+            if reset_in is not None:
+                state.reset_at = time.monotonic() + reset_in
+
+    def _sideline(self, state: KeyState, headers, quota: bool):
+        retry_after = parse_duration(headers.get("retry-after"))
+        _, _, reset_in = self._parse_headers(headers) # e.g. OpenRouter only reports X-RateLimit-Reset on a 429
+        if quota:
+            seconds = QUOTA_SIDELINE_SECONDS
+        elif retry_after is not None:
+            seconds = retry_after
+        elif reset_in:
+            seconds = reset_in
+        else:
+            seconds = DEFAULT_SIDELINE_SECONDS
+        with self._condition:
+            state.rate_limited += 1
+            state.sidelined_until = time.monotonic() + seconds
+        logger.warning(
+            "key_rate_limited",
+            extra={"event": "key_rate_limited", "provider": self.provider, "key": state.name,
+                   "sidelined_seconds": round(seconds, 1), "quota": quota},
+        )
+
+    def stats(self) -> dict:
+        """Returns the pool's concurrency and per-key counters."""
+        with self._condition:
+            now = time.monotonic()
+            return {
+                "concurrency_limit": round(self.limit, 1),
+                "in_flight": self.in_flight,
+                "keys": [
+                    {"key": key.name, "requests": key.requests, "rate_limited": key.rate_limited,
+                     "remaining_requests": key.remaining_requests, "remaining_tokens": key.remaining_tokens,
+                     "sidelined": now < key.sidelined_until}
+                    for key in self.keys
+                ],
+            }
@@ -0,0 +1,162 @@
+import threading
+import logging
+import collections
+import re
+import os
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# --- Routing table ---
+# Model used by each fixed-model command. Change a command's model here rather than in main.py.
+ROUTING_TABLE = {
+    "gpt_correct_grammar": "gpt-3.5-turbo-16k",
+    "gpt_single_page_website": "gpt-3.5-turbo-16k",
+    "gpt_text_to_emoji": "gpt-3.5-turbo-16k",
+    "gpt_text_to_block_letters": "gpt-3.5-turbo-16k",
+    "gpt_debug_code": "gpt-4",
+    "gpt_short_story": "gpt-4",
+    "ask_gpt": "auto",
+}
+
+# Models "auto" can choose from, with the latency assumed before any calls have been observed
+FAST_MODEL = "gpt-3.5-turbo-16k"
+STRONG_MODEL = "gpt-4"
+DEFAULT_LATENCY_MS = {
+    FAST_MODEL: 3000,
+    STRONG_MODEL: 10000,
+}
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    ROUTER_TARGET_LATENCY_MS = int(os.getenv("ROUTER_TARGET_LATENCY_MS", "12000"))
+except ValueError:
+    ROUTER_TARGET_LATENCY_MS = 12000
+try:
+    ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.3"))
+except ValueError:
+    ROUTER_MAX_ERROR_RATE = 0.3
+
+# Weight of the newest observation in the moving averages
+EWMA_ALPHA = 0.2
+# Complexity score at which "auto" prefers the strong model, and at which it ignores the latency target
+STRONG_THRESHOLD = 3
+FORCE_STRONG_THRESHOLD = 6
+
+_CODE_PATTERN = re.compile(r"```|\bdef |\bclass |\bfunction\b|#include|=>|[{};]\s*$", re.MULTILINE)
+_REASONING_WORDS = re.compile(
+    r"\b(why|explain|compare|difference|prove|derive|analy[sz]e|evaluate|optimi[sz]e|debug|design|"
+    r"step[- ]by[- ]step|pros and cons|trade-?offs?|algorithm|calculate|solve)\b",
+    re.IGNORECASE,
+)
+
+
+def complexity_score(prompt: str) -> int:
+    """Scores how demanding a prompt is from its length and content. Higher means a stronger model is more useful."""
+    score = 0
+    if len(prompt) > 80:
+        score += 1
+    if len(prompt) > 160:
+        score += 1
+    if _CODE_PATTERN.search(prompt):
+        score += 2
+    score += min(len(_REASONING_WORDS.findall(prompt)), 3) * 2
+    if prompt.count("?") > 1:
+        score += 1
+    return score
+
+
+class ModelStats:
+    """Moving averages of latency and error rate for one model serving one command."""
+    def __init__(self, model: str):
+        self.latency_ms = DEFAULT_LATENCY_MS.get(model, ROUTER_TARGET_LATENCY_MS)
+        self.error_rate = 0.0
+        self.calls = 0
+
+    def observe(self, latency_ms: float, ok: bool):
+        self.calls += 1
+        if ok: # Failed calls often return early, so they only count towards the error rate
+            self.latency_ms += EWMA_ALPHA * (latency_ms - self.latency_ms)
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def relax(self, model: str):
+        """
+        Moves the stats a small step back towards their defaults. Called when the model is skipped for being
+        slow or failing, so it gets retried eventually instead of being avoided forever.
+        """
+        default_latency = DEFAULT_LATENCY_MS.get(model, ROUTER_TARGET_LATENCY_MS)
+        self.latency_ms += EWMA_ALPHA / 4 * (default_latency - self.latency_ms)
+        self.error_rate -= EWMA_ALPHA / 4 * self.error_rate
+
+
+class ModelRouter:
+    """
+    Picks models for commands. Fixed commands use ROUTING_TABLE, "auto" is resolved from the
+    prompt's complexity plus live latency/error stats, keeping within ROUTER_TARGET_LATENCY_MS.
+    Stats are kept per (command, model), since commands ask for very different amounts of output:
+    a short story on GPT-4 says nothing about how fast GPT-4 answers an /ask_gpt question.
+    Every decision is logged as a structured "routing_decision" record and kept in `recent_decisions`.
+    """
+    def __init__(self):
+        self.stats = {} # (command, model) -> ModelStats
+        self.recent_decisions = collections.deque(maxlen=500)
+        self._lock = threading.Lock()
+
+    def model_for(self, command: str, prompt: str = "", requested: str | None = None) -> str:
+        """Returns the model to use for a command. `requested` overrides the routing table (e.g. a user's choice)."""
+        model = requested or ROUTING_TABLE.get(command, FAST_MODEL)
+        if model != "auto":
+            return model
+        return self._route_auto(command, prompt)
+
+    def _route_auto(self, command: str, prompt: str) -> str:
+        score = complexity_score(prompt)
+        with self._lock:
+            fast, strong = self._stats_for(command, FAST_MODEL), self._stats_for(command, STRONG_MODEL)
+            model, reason = FAST_MODEL, "simple prompt"
+            if score >= STRONG_THRESHOLD:
+                model, reason = STRONG_MODEL, "complex prompt"
+                if strong.error_rate > ROUTER_MAX_ERROR_RATE:
+                    model, reason = FAST_MODEL, "strong model error rate too high"
+                    strong.relax(STRONG_MODEL)
+                elif strong.latency_ms > ROUTER_TARGET_LATENCY_MS and score < FORCE_STRONG_THRESHOLD:
+                    model, reason = FAST_MODEL, "strong model over latency target"
+                    strong.relax(STRONG_MODEL)
+            elif fast.error_rate > ROUTER_MAX_ERROR_RATE and strong.error_rate < fast.error_rate:
+                model, reason = STRONG_MODEL, "fast model error rate too high"
+                fast.relax(FAST_MODEL)
+
+            decision = {
+                "command": command,
+                "model": model,
+                "reason": reason,
+                "score": score,
+                "prompt_chars": len(prompt),
+                "fast_latency_ms": round(fast.latency_ms),
+                "strong_latency_ms": round(strong.latency_ms),
+                "fast_error_rate": round(fast.error_rate, 3),
+                "strong_error_rate": round(strong.error_rate, 3),
+            }
+            self.recent_decisions.append(decision)
+        logger.info("routing_decision", extra={"event": "routing_decision", **decision})
+        return model
+
+    def _stats_for(self, command: str, model: str) -> ModelStats:
+        """Returns the stats of a model for one command, creating them on first use. Call with the lock held."""
+        stats = self.stats.get((command, model))
+        if stats is None:
+            stats = self.stats[(command, model)] = ModelStats(model)
+        return stats
+
+    def observe(self, command: str, model: str | None, latency_ms: float, ok: bool):
+        """Feeds the outcome of an upstream call into the model's stats for that command."""
+        if not model:
+            return
+        with self._lock:
+            self._stats_for(command, model).observe(latency_ms, ok)
+        logger.info(
+            "routing_outcome",
+            extra={"event": "routing_outcome", "command": command, "model": model, "latency_ms": round(latency_ms), "ok": ok},
+        )
@@ -0,0 +1,191 @@
+"""
+Replays traffic traces recorded by Traffic_Recorder.py against local stand-ins for Discord and the model APIs.
+
+Commands arrive at their recorded times divided by --speed, so --speed 10 replays ten times the recorded load.
+Upstream calls are simulated by sleeping for their recorded duration in a thread pool the size of the bot's API
+executor, which reproduces the queueing the bot would see. Usage:
+
+    python Replay_Traffic.py traffic.jsonl --speed 20
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random
+import sys
+import time
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+from Traffic_Recorder import ERROR, CACHED, LOCAL, REJECTED
+from Key_Pool import API_WORKERS
+
+DEFAULT_WORKERS = API_WORKERS # Same as the bot's API executor
+
+
+class FakeDiscord:
+    """Stand-in for Discord's interaction endpoints: every response or followup costs one round trip."""
+    def __init__(self, round_trip_ms: float):
+        self.round_trip = round_trip_ms / 1000
+        self.calls = 0
+
+    async def respond(self):
+        self.calls += 1
+        await asyncio.sleep(self.round_trip * random.uniform(0.8, 1.2))
+
+
+class FakeModelAPI:
+    """Stand-in for the model APIs: blocks the calling thread for the recorded upstream time."""
+    def __init__(self, time_scale: float):
+        self.time_scale = time_scale
+        self.calls = 0
+
+    def call(self, upstream_ms: float, outcome: str):
+        self.calls += 1
+        time.sleep(upstream_ms / 1000 * self.time_scale)
+        if outcome == ERROR:
+            raise RuntimeError("Recorded upstream error")
+        return "ok"
+
+
+class Replay:
+    def __init__(self, records: list, speed: float, workers: int, discord_ms: float, scale_service: bool):
+        self.records = records
+        self.speed = speed
+        self.discord = FakeDiscord(discord_ms)
+        self.model_api = FakeModelAPI(1 / speed if scale_service else 1.0)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.latencies = {} # command -> list of end to end latencies (ms)
+        self.queue_waits = []
+        self.outcomes = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+
+    async def run_command(self, record: list):
+        _, command, _prompt_chars, total_ms, upstream_ms, outcome, _user = record
+        start = time.monotonic()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if upstream_ms is None or outcome in (CACHED, LOCAL, REJECTED):
+                # Answered without an upstream call: one response, plus any local work that was recorded
+                if total_ms:
+                    await asyncio.sleep(max(total_ms - self.discord.round_trip * 1000, 0) / 1000 * self.model_api.time_scale)
+                await self.discord.respond()
+            else:
+                await self.discord.respond() # defer
+                loop = asyncio.get_running_loop()
+                submitted = time.monotonic()
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+
+                def upstream():
+                    # Runs in the pool: time between submit and start is queueing for a worker
+                    self.queue_waits.append((time.monotonic() - submitted) * 1000)
+                    return self.model_api.call(upstream_ms, outcome)
+
+                try:
+                    await loop.run_in_executor(self.executor, upstream)
+                except RuntimeError:
+                    pass # Recorded errors still send an error followup
+                finally:
+                    self.waiting -= 1
+                await self.discord.respond() # followup
+        finally:
+            self.in_flight -= 1
+        self.latencies.setdefault(command, []).append((time.monotonic() - start) * 1000)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def run(self) -> float:
+        first_ts = self.records[0][0]
+        start = time.monotonic()
+        tasks = []
+        for record in self.records:
+            delay = (record[0] - first_ts) / self.speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.run_command(record)))
+        await asyncio.gather(*tasks)
+        self.executor.shutdown()
+        return time.monotonic() - start
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def load_trace(path: str, limit: int | None) -> list:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, list) and len(record) == 7:
+                records.append(record)
+    records.sort(key=lambda record: record[0])
+    return records[:limit] if limit else records
+
+
+def format_row(name: str, values: list) -> str:
+    return (f"{name:<28}{len(values):>8}{percentile(values, 50):>10.0f}{percentile(values, 90):>10.0f}"
+            f"{percentile(values, 99):>10.0f}{max(values, default=0):>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded bot traffic against local stand-ins.")
+    parser.add_argument("trace", help="Trace file written by the bot (TRAFFIC_CAPTURE_PATH)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed from 1 to 100 (default 1)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Executor threads (default {DEFAULT_WORKERS}, same as the bot)")
+    parser.add_argument("--discord-ms", type=float, default=80.0, help="Simulated Discord round trip in ms (default 80)")
+    parser.add_argument("--scale-service", action="store_true",
+                        help="Also divide upstream times by --speed (replays the trace faster instead of at higher load)")
+    parser.add_argument("--limit", type=int, help="Only replay the first N commands")
+    args = parser.parse_args()
+
+    if not 1 <= args.speed <= 100:
+        sys.exit("--speed must be between 1 and 100.")
+    records = load_trace(args.trace, args.limit)
+    if not records:
+        sys.exit(f"No trace records found in {args.trace}.")
+
+    span = records[-1][0] - records[0][0]
+    print(f"Replaying {len(records)} commands recorded over {span:.0f}s at {args.speed:g}x with {args.workers} workers...")
+
+    replay = Replay(records, args.speed, args.workers, args.discord_ms, args.scale_service)
+    cpu_start = time.process_time()
+    wall = asyncio.run(replay.run())
+    cpu = time.process_time() - cpu_start
+
+    all_latencies = [value for values in replay.latencies.values() for value in values]
+    print(f"\nFinished in {wall:.1f}s ({len(records) / wall if wall else 0:.1f} commands/s)\n")
+    print(f"{'Latency (ms)':<28}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for command in sorted(replay.latencies):
+        print(format_row(f"/{command}", replay.latencies[command]))
+    print(format_row("all commands", all_latencies))
+    print(format_row("executor queue wait", replay.queue_waits))
+
+    print(f"\nOutcomes: {', '.join(f'{name}={count}' for name, count in sorted(replay.outcomes.items()))}")
+    print(f"Peak in-flight commands: {replay.peak_in_flight}")
+    print(f"Peak commands in the executor (running or queued): {replay.peak_waiting}")
+    print(f"Stand-in calls: Discord={replay.discord.calls}, model API={replay.model_api.calls}")
+    print(f"CPU time: {cpu:.2f}s ({cpu / wall * 100 if wall else 0:.1f}% of one core)")
+    if resource:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin": # Linux reports KB, macOS reports bytes
+            peak_rss *= 1024
+        print(f"Peak memory: {peak_rss / (1024 * 1024):.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
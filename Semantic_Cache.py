@@ -0,0 +1,288 @@
+import threading
+import sys
+import logging
+import hashlib
+import re
+import os
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# --- Settings (all optional, read from the environment) ---
+try:
+    # Cosine similarity (0 to 1) a cached question needs to be served for a new one
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+except ValueError:
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+try:
+    SEMANTIC_CACHE_MAX_MB = float(os.getenv("SEMANTIC_CACHE_MAX_MB", "16")) # Memory cap across all guilds
+except ValueError:
+    SEMANTIC_CACHE_MAX_MB = 16
+try:
+    SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+except ValueError:
+    SEMANTIC_CACHE_TTL_SECONDS = 86400
+
+# Size of the hashed n-gram vectors
+EMBEDDING_DIM = 1024
+SEMANTIC_CACHE_MAX_BYTES = max(int(SEMANTIC_CACHE_MAX_MB * 1024 * 1024), 1024 * 1024)
+MAX_RESPONSE_CHARS = 4096 # Longer answers are cut, an embed can't show more anyway
+INITIAL_ROWS = 64 # Rows of the shared matrix before it first grows
+# Bytes per matrix row: the float32 vector plus scope ID, created and last used time
+ROW_BYTES = EMBEDDING_DIM * 4 + 4 + 8 + 8
+
+_NORMALIZE_PATTERN = re.compile(r"[^\w\s]")
+_CONTRACTIONS = {"what's": "what is", "whats": "what is", "who's": "who is", "how's": "how is", "where's": "where is",
+                 "it's": "it is", "that's": "that is", "can't": "cannot", "don't": "do not", "doesn't": "does not",
+                 "isn't": "is not", "won't": "will not", "i'm": "i am"}
+# Words that don't change what a question asks. Everything else (including question words and negations)
+# is a content word, see content_matches.
+STOP_WORDS = frozenset(
+    "a an the is are was were be been being am of to in on at for by with about as and or do does did "
+    "i me my you your it its this that these those can could would should will please tell give".split()
+)
+# Content words that flip a question's meaning, so they are never allowed as the one extra word
+NEGATIONS = frozenset("not no never without cannot nor".split())
+
+
+def normalize(text: str) -> str:
+    """Lowercases, expands common contractions and strips punctuation."""
+    words = [_CONTRACTIONS.get(word, word) for word in text.lower().split()]
+    return " ".join(_NORMALIZE_PATTERN.sub("", " ".join(words)).split())
+
+
+def content_words(text: str) -> tuple[str, ...]:
+    """Returns the question's content words (everything but STOP_WORDS), in order."""
+    return tuple(word for word in normalize(text).split() if word not in STOP_WORDS)
+
+
+def content_matches(a: tuple[str, ...], b: tuple[str, ...]) -> bool:
+    """
+    Guard against similar looking but different questions: the content words must be the same, in the same order,
+    except for at most one extra word in either question (not a negation). Swapped words ("austria" vs
+    "australia") or reordered words ("celsius to fahrenheit" vs "fahrenheit to celsius") never match.
+    """
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) != 1:
+        return False
+    longer, shorter = (a, b) if len(a) > len(b) else (b, a)
+    return any(
+        longer[:i] + longer[i + 1:] == shorter and longer[i] not in NEGATIONS
+        for i in range(len(longer))
+    )
+
+
+def _words_size(words: tuple[str, ...]) -> int:
+    """Memory used by a tuple of content words."""
+    return sys.getsizeof(words) + sum(sys.getsizeof(word) for word in words)
+
+
+def _bucket(feature: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest(), "little") % EMBEDDING_DIM
+
+
+def embed(text: str) -> np.ndarray:
+    """
+    CPU-only text embedding: word unigrams/bigrams and character trigrams hashed into a fixed size,
+    L2-normalized vector, so a dot product between two embeddings is their cosine similarity.
+    """
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    words = normalize(text).split()
+    features = [f"w:{word}" for word in words]
+    features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    for feature in features:
+        # Whole words carry more meaning than character fragments
+        vector[_bucket(feature)] += 2.0 if feature.startswith("w:") else 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    Cache for near-duplicate questions ("what is rust" vs "What's Rust?").
+
+    Entries are scoped (e.g. per guild and command/model), looked up by cosine similarity over
+    hashed n-gram embeddings, with content_matches as a guard against near misses, and expire
+    after SEMANTIC_CACHE_TTL_SECONDS. All scopes share one matrix that grows as needed, and the least
+    recently used entries are evicted once the matrix plus the stored answers would exceed max_bytes.
+    """
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_bytes: int = SEMANTIC_CACHE_MAX_BYTES,
+                 ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = 0
+        self._allocate(INITIAL_ROWS)
+        self.responses = []
+        self.questions = [] # Content words of each row's question
+        self.response_bytes = 0 # Answers and content words
+        self.scope_ids = {} # scope name -> ID used in the scope column
+        self.scope_sizes = {} # scope ID -> number of entries
+        self._scope_names = {} # scope ID -> scope name
+        self._next_scope_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _allocate(self, rows: int):
+        """Resizes the shared matrix and its columns to `rows`, keeping the current entries."""
+        old = getattr(self, "vectors", None)
+        columns = [("vectors", np.float32, (rows, EMBEDDING_DIM)), ("scopes", np.int32, rows),
+                   ("created", np.float64, rows), ("last_used", np.float64, rows)]
+        for name, dtype, shape in columns:
+            array = np.zeros(shape, dtype=dtype)
+            if old is not None:
+                array[:self.entries] = getattr(self, name)[:self.entries]
+            setattr(self, name, array)
+        self.capacity = rows
+
+    def memory_bytes(self) -> int:
+        """Memory used by the matrix and the stored answers."""
+        return self.capacity * ROW_BYTES + self.response_bytes
+
+    def _matches(self, scope_id: int, vector: np.ndarray, words: tuple[str, ...], threshold: float):
+        """Yields (row, similarity) for rows in a scope at or above the threshold that pass content_matches, best first."""
+        rows = np.flatnonzero(self.scopes[:self.entries] == scope_id)
+        if not len(rows):
+            return
+        similarities = self.vectors[rows] @ vector
+        for index in np.argsort(-similarities):
+            similarity = float(similarities[index])
+            if similarity < threshold:
+                return
+            row = int(rows[index])
+            if content_matches(self.questions[row], words):
+                yield row, similarity
+
+    def get(self, scope: str, question: str) -> tuple[str, float] | None:
+        """Returns (response, similarity) for the most similar matching question in the scope, or None on a miss."""
+        vector = embed(question)
+        words = content_words(question)
+        now = time.time()
+        with self._lock:
+            scope_id = self.scope_ids.get(scope)
+            if scope_id is not None and vector.any():
+                for row, similarity in self._matches(scope_id, vector, words, self.threshold):
+                    if now - self.created[row] > self.ttl_seconds:
+                        continue
+                    self.last_used[row] = now
+                    self.hits += 1
+                    return self.responses[row], similarity
+            self.misses += 1
+            return None
+
+    def put(self, scope: str, question: str, response: str):
+        """Caches a response for a question in a scope."""
+        vector = embed(question)
+        if not vector.any():
+            return
+        words = content_words(question)
+        response = response[:MAX_RESPONSE_CHARS]
+        response_size = sys.getsizeof(response)
+        now = time.time()
+        with self._lock:
+            scope_id = self.scope_ids.get(scope)
+            if scope_id is not None:
+                # Same question, refresh the answer instead of adding a duplicate
+                for row, _ in self._matches(scope_id, vector, words, 0.999):
+                    if self.questions[row] == words:
+                        self.response_bytes += response_size - sys.getsizeof(self.responses[row])
+                        self.responses[row] = response
+                        self.created[row] = now
+                        self.last_used[row] = now
+                        return
+            response_size += _words_size(words)
+
+            self._make_room(now, response_size)
+            if self.entries == self.capacity:
+                self._allocate(max(self._grown_rows(response_size), self.capacity + 1))
+
+            if scope not in self.scope_ids: # Looked up again, eviction may have removed the scope
+                self.scope_ids[scope] = self._next_scope_id
+                self._scope_names[self._next_scope_id] = scope
+                self.scope_sizes[self._next_scope_id] = 0
+                self._next_scope_id += 1
+            scope_id = self.scope_ids[scope]
+            row = self.entries
+            self.vectors[row] = vector
+            self.scopes[row] = scope_id
+            self.created[row] = now
+            self.last_used[row] = now
+            self.responses.append(response)
+            self.questions.append(words)
+            self.response_bytes += response_size
+            self.scope_sizes[scope_id] += 1
+            self.entries += 1
+
+    def _make_room(self, now: float, response_size: int):
+        """
+        Drops expired entries, then the least recently used entries until a new entry fits in max_bytes,
+        counting the matrix growth it may need. Shrinks the matrix when it's mostly empty.
+        """
+        size = self.entries
+        for row in sorted(np.flatnonzero(now - self.created[:size] > self.ttl_seconds), reverse=True):
+            self._remove(int(row))
+
+        while self.entries:
+            # A full matrix has to grow for the new entry, unless evicting frees a row
+            if self.entries < self.capacity:
+                fitting_rows = (self.max_bytes - self.response_bytes - response_size) // ROW_BYTES
+                if self.capacity <= fitting_rows:
+                    break
+                if fitting_rows > self.entries: # Give up unused rows before evicting answers
+                    self._allocate(fitting_rows)
+                    break
+            elif self._grown_rows(response_size) > self.capacity:
+                break
+            self._remove(int(np.argmin(self.last_used[:self.entries])))
+
+        if self.capacity > INITIAL_ROWS and self.entries < self.capacity // 4:
+            self._allocate(max(self.capacity // 2, INITIAL_ROWS))
+
+    def _grown_rows(self, response_size: int) -> int:
+        """Rows the matrix can grow to: double, or as many as still fit in max_bytes with a new answer."""
+        return min(self.capacity * 2, (self.max_bytes - self.response_bytes - response_size) // ROW_BYTES)
+
+    def _remove(self, row: int):
+        """Removes an entry by moving the last entry into its row."""
+        last = self.entries - 1
+        scope_id = int(self.scopes[row])
+        self.response_bytes -= sys.getsizeof(self.responses[row]) + _words_size(self.questions[row])
+        if row != last:
+            for column in (self.vectors, self.scopes, self.created, self.last_used):
+                column[row] = column[last]
+            self.responses[row] = self.responses[last]
+            self.questions[row] = self.questions[last]
+        self.responses.pop()
+        self.questions.pop()
+        self.entries -= 1
+        self.evictions += 1
+        self.scope_sizes[scope_id] -= 1
+        if not self.scope_sizes[scope_id]:
+            del self.scope_sizes[scope_id]
+            del self.scope_ids[self._scope_names.pop(scope_id)]
+
+    def stats(self) -> dict:
+        """Returns hit-rate and memory metrics."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.entries,
+                "scopes": len(self.scope_ids),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_bytes": self.memory_bytes(),
+                "max_bytes": self.max_bytes,
+            }
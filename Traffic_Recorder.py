@@ -0,0 +1,108 @@
+import threading
+import queue
+import logging
+import hashlib
+import json
+import os
+import secrets
+import time
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# Traces are only recorded when a capture file is configured
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+
+# Outcomes recorded for a command
+OK = "ok" # Answered by the API
+ERROR = "error" # Failed
+EMPTY = "empty" # API returned nothing
+CACHED = "cached" # Answered from the semantic cache
+LOCAL = "local" # Answered locally without an API call (e.g. emoji index, utility commands)
+REJECTED = "rejected" # Refused before going upstream (budget, validation, drain mode)
+
+
+class TraceSpan:
+    """Timing for one command. Call finish() once with the outcome, later calls are ignored."""
+    def __init__(self, recorder: "TrafficRecorder", command: str, prompt_chars: int, user_id: int):
+        self.recorder = recorder
+        self.command = command
+        self.prompt_chars = prompt_chars
+        self.user_id = user_id
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.finished = False
+
+    def finish(self, outcome: str, upstream_ms: float | None = None):
+        if self.finished:
+            return
+        self.finished = True
+        total_ms = (time.monotonic() - self._start) * 1000
+        self.recorder.write(self, outcome, total_ms, upstream_ms)
+
+
+class TrafficRecorder:
+    """
+    Opt-in recorder of anonymized command traces for load replay (see Replay_Traffic.py).
+
+    Each command becomes one JSON-lines array:
+    [ts, command, prompt_chars, total_ms, upstream_ms, outcome, user]
+    `user` is a hash salted per process, so concurrent requests from one user can be told apart
+    without the trace containing IDs or prompt text. Writes happen on a background thread.
+    """
+    def __init__(self, path: str | None = TRAFFIC_CAPTURE_PATH):
+        self.path = path
+        self.enabled = bool(path)
+        self._salt = secrets.token_bytes(16)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        if self.enabled:
+            self._thread = threading.Thread(target=self._writer, name="traffic-recorder", daemon=True)
+            self._thread.start()
+            logger.info(f"Recording traffic traces to {self.path}.")
+
+    def start(self, command: str, prompt_chars: int, user_id: int) -> TraceSpan:
+        """Starts timing a command."""
+        return TraceSpan(self, command, prompt_chars, user_id)
+
+    def write(self, span: TraceSpan, outcome: str, total_ms: float, upstream_ms: float | None):
+        if not self.enabled:
+            return
+        user = hashlib.blake2b(str(span.user_id).encode(), key=self._salt, digest_size=4).hexdigest()
+        self._queue.put([
+            round(span.started, 3),
+            span.command,
+            span.prompt_chars,
+            round(total_ms),
+            round(upstream_ms) if upstream_ms is not None else None,
+            outcome,
+            user,
+        ])
+
+    def _writer(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch: # Sentinel from close()
+                stop = True
+                batch = [entry for entry in batch if entry is not None]
+            if not batch:
+                continue
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(entry, separators=(",", ":")) + "\n" for entry in batch)
+            except OSError as e:
+                logger.error(f"Failed to write traffic trace: {e}")
+
+    def close(self, timeout: float = 5.0):
+        """Flushes pending traces and stops the writer thread."""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
@@ -0,0 +1,261 @@
+import threading
+import queue
+import logging
+import json
+import os
+import time
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int = 0) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"{name} must be a whole number, using {default}.")
+        return default
+
+
+# --- Settings (all optional, read from the environment) ---
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", "usage_ledger.jsonl")
+USAGE_ROLLUP_PATH = os.getenv("USAGE_ROLLUP_PATH", "usage_rollups.json")
+USAGE_FLUSH_SECONDS = _env_int("USAGE_FLUSH_SECONDS", 60)
+
+# Budgets, 0 means unlimited. Tokens count prompt + completion tokens.
+BUDGETS = {
+    ("u", "day", "tokens"): _env_int("USAGE_USER_DAILY_TOKENS"),
+    ("u", "month", "tokens"): _env_int("USAGE_USER_MONTHLY_TOKENS"),
+    ("u", "day", "images"): _env_int("USAGE_USER_DAILY_IMAGES"),
+    ("u", "month", "images"): _env_int("USAGE_USER_MONTHLY_IMAGES"),
+    ("g", "day", "tokens"): _env_int("USAGE_GUILD_DAILY_TOKENS"),
+    ("g", "month", "tokens"): _env_int("USAGE_GUILD_MONTHLY_TOKENS"),
+    ("g", "day", "images"): _env_int("USAGE_GUILD_DAILY_IMAGES"),
+    ("g", "month", "images"): _env_int("USAGE_GUILD_MONTHLY_IMAGES"),
+}
+
+# Number of periods kept in memory, older rollups are dropped (the ledger keeps everything)
+DAYS_KEPT = 35
+MONTHS_KEPT = 13
+
+# Layout of a rollup counter
+TOKENS, IMAGES, REQUESTS, LATENCY_MS = range(4)
+
+
+def period_keys(ts: float) -> tuple[str, str]:
+    """Returns the (day, month) rollup period keys for a unix timestamp (UTC)."""
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    return "d" + dt.strftime("%Y-%m-%d"), "m" + dt.strftime("%Y-%m")
+
+
+class UsageLedger:
+    """
+    Append-only usage ledger with pre-aggregated rollups.
+
+    Every upstream call is appended to a JSON-lines ledger as a compact array:
+    [ts, user_id, guild_id, command, model, prompt_tokens, completion_tokens, images, latency_ms]
+    Counters per day/month for each user ("u:<id>"), guild ("g:<id>"), command ("c:<name>") and
+    guild command ("gc:<id>:<name>") are kept in memory and periodically written to disk, so budget
+    checks and /usage queries are dictionary lookups. The rollup snapshot records how far into the
+    ledger it goes, and entries appended after it are replayed on startup.
+    Disk writes happen on a background thread so the event loop never waits on them.
+    """
+    def __init__(self, ledger_path: str = USAGE_LEDGER_PATH, rollup_path: str = USAGE_ROLLUP_PATH,
+                 flush_seconds: int = USAGE_FLUSH_SECONDS):
+        self.ledger_path = ledger_path
+        self.rollup_path = rollup_path
+        self.flush_seconds = max(flush_seconds, 1)
+        self.rollups = {} # period -> scope key -> [tokens, images, requests, latency_ms]
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._dirty = False
+        self._recorded = 0 # Entries recorded since startup
+        self._written = 0 # Entries the writer handled since startup, appended or dropped (writer thread only)
+        self._ledger_offset = 0 # Ledger size in bytes after the last append (writer thread only)
+        self._load()
+        self._thread = threading.Thread(target=self._writer, name="usage-ledger", daemon=True)
+        self._thread.start()
+
+    # --- Recording ---
+    def record(self, user_id: int, guild_id: int | None, command: str, model: str | None,
+               prompt_tokens: int = 0, completion_tokens: int = 0, images: int = 0, latency_ms: int = 0):
+        """Appends a usage entry to the ledger and updates the rollups."""
+        ts = time.time()
+        entry = [round(ts, 3), user_id, guild_id, command, model, prompt_tokens, completion_tokens, images, latency_ms]
+        with self._lock:
+            self._apply(entry)
+            # Queued in the order entries are counted, so the snapshot knows which appends it already includes
+            self._recorded += 1
+            self._queue.put(entry)
+
+    def _apply(self, entry: list):
+        """Adds a ledger entry to the rollups. Call with the lock held."""
+        ts, user_id, guild_id, command, _model, prompt_tokens, completion_tokens, images, latency_ms = entry
+        scopes = [f"u:{user_id}", f"c:{command}"]
+        if guild_id:
+            scopes += [f"g:{guild_id}", f"gc:{guild_id}:{command}"]
+        for period in period_keys(ts):
+            counters = self.rollups.setdefault(period, {})
+            for scope in scopes:
+                counter = counters.setdefault(scope, [0, 0, 0, 0])
+                counter[TOKENS] += prompt_tokens + completion_tokens
+                counter[IMAGES] += images
+                counter[REQUESTS] += 1
+                counter[LATENCY_MS] += latency_ms
+        self._dirty = True
+
+    # --- Queries ---
+    def get(self, scope: str, period: str) -> list:
+        """Returns the [tokens, images, requests, latency_ms] counter for a scope ("u:<id>" etc.) in a period key."""
+        with self._lock:
+            return list(self.rollups.get(period, {}).get(scope, [0, 0, 0, 0]))
+
+    def get_current(self, scope: str) -> dict:
+        """Returns today's and this month's counters for a scope."""
+        day, month = period_keys(time.time())
+        return {"day": self.get(scope, day), "month": self.get(scope, month)}
+
+    def top_commands(self, guild_id: int, limit: int = 5) -> list[tuple[str, list]]:
+        """Returns this month's busiest commands in a guild, by tokens then requests."""
+        _, month = period_keys(time.time())
+        prefix = f"gc:{guild_id}:"
+        with self._lock:
+            rows = [(scope[len(prefix):], list(counter)) for scope, counter in self.rollups.get(month, {}).items()
+                    if scope.startswith(prefix)]
+        rows.sort(key=lambda row: (row[1][TOKENS], row[1][REQUESTS]), reverse=True)
+        return rows[:limit]
+
+    def check_budget(self, user_id: int, guild_id: int | None, tokens: int = 0, images: int = 0) -> str | None:
+        """
+        Checks the configured budgets before a request goes upstream.
+        `tokens`/`images` are the expected cost of the request. Returns a message if a budget would be exceeded, otherwise None.
+        """
+        scopes = [("u", f"u:{user_id}", "your")]
+        if guild_id:
+            scopes.append(("g", f"g:{guild_id}", "this server's"))
+        current = {scope: self.get_current(scope) for _, scope, _ in scopes}
+        for kind, scope, owner in scopes:
+            for period in ("day", "month"):
+                counter = current[scope][period]
+                for unit, index, cost in (("tokens", TOKENS, tokens), ("images", IMAGES, images)):
+                    if cost <= 0:
+                        continue
+                    budget = BUDGETS[(kind, period, unit)]
+                    if budget and counter[index] + cost > budget:
+                        label = "daily" if period == "day" else "monthly"
+                        return f"This request would exceed {owner} {label} {unit} budget ({counter[index]:,}/{budget:,} used). Please try again later."
+        return None
+
+    # --- Persistence ---
+    def _load(self):
+        """
+        Loads the rollup snapshot and replays the ledger entries appended after it. Rebuilds the rollups from
+        the whole ledger if the snapshot is missing, unreadable, from an older version or ahead of the ledger.
+        """
+        offset, skip, loaded = 0, 0, False
+        if os.path.exists(self.rollup_path):
+            try:
+                with open(self.rollup_path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                if "rollups" in snapshot:
+                    self.rollups = snapshot["rollups"]
+                    offset, skip = snapshot["ledger_offset"], snapshot["ledger_skip"]
+                    loaded = True
+                else:
+                    logger.warning("Usage rollups don't record their ledger position, rebuilding from ledger.")
+            except (OSError, json.JSONDecodeError, KeyError, TypeError) as e:
+                logger.error(f"Could not read usage rollups from {self.rollup_path}, rebuilding from ledger: {e}")
+                self.rollups = {}
+
+        if not os.path.exists(self.ledger_path):
+            return
+        if offset > os.path.getsize(self.ledger_path):
+            logger.error(f"Usage ledger {self.ledger_path} is shorter than the rollups expect, rebuilding from ledger.")
+            self.rollups, offset, skip, loaded = {}, 0, 0, False
+        replayed = 0
+        with open(self.ledger_path, "rb") as f, self._lock:
+            f.seek(offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    if skip: # Already counted in the snapshot, but appended after it was taken
+                        skip -= 1
+                        continue
+                    self._apply(entry)
+                    replayed += 1
+                except (json.JSONDecodeError, ValueError, TypeError):
+                    continue
+            self._ledger_offset = f.tell()
+        self._prune()
+        if not loaded:
+            logger.info(f"Rebuilt usage rollups from {replayed} ledger entries.")
+        elif replayed:
+            logger.info(f"Replayed {replayed} ledger entries written after the last usage rollup snapshot.")
+
+    def _prune(self):
+        with self._lock:
+            days = sorted(p for p in self.rollups if p.startswith("d"))
+            months = sorted(p for p in self.rollups if p.startswith("m"))
+            for period in days[:-DAYS_KEPT] + months[:-MONTHS_KEPT]:
+                del self.rollups[period]
+
+    def _write_rollups(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = json.dumps({
+                "ledger_offset": self._ledger_offset,
+                "ledger_skip": self._recorded - self._written, # Counted here, but not appended yet
+                "rollups": self.rollups,
+            }, separators=(",", ":"))
+            self._dirty = False
+        tmp_path = self.rollup_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, self.rollup_path)
+
+    def _writer(self):
+        """Background thread: appends ledger entries in batches and snapshots rollups every flush_seconds."""
+        last_flush = time.monotonic()
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=1.0))
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch: # Sentinel from close()
+                stop = True
+                batch = [entry for entry in batch if entry is not None]
+            if batch:
+                try:
+                    with open(self.ledger_path, "ab") as f:
+                        f.write("".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in batch).encode("utf-8"))
+                        self._ledger_offset = f.tell()
+                except OSError as e:
+                    logger.error(f"Failed to append {len(batch)} entries to the usage ledger, only the rollups count them: {e}")
+                    try:
+                        # Part of the batch may have been written, it's already counted so it's never replayed
+                        self._ledger_offset = os.path.getsize(self.ledger_path)
+                    except OSError:
+                        pass
+                # Handled even if the append failed, otherwise the snapshot would skip entries appended later
+                self._written += len(batch)
+            try:
+                if stop or time.monotonic() - last_flush >= self.flush_seconds:
+                    self._prune()
+                    self._write_rollups()
+                    last_flush = time.monotonic()
+            except OSError as e:
+                logger.error(f"Failed to write usage rollups: {e}")
+
+    def close(self, timeout: float = 5.0):
+        """Flushes pending ledger entries and rollups to disk and stops the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
@@ -1,19 +1,42 @@
 import discord
+import aiohttp
+import openai
 import functools
 from discord import app_commands, ui # Import ui for Views
 import sys
 import os
 from dotenv import load_dotenv
-from Chat_GPT_Function import gpt, deepseek, dalle3, dalle2
+from Chat_GPT_Function import gpt, deepseek, dalle3, dalle2, openai_key_pool, openrouter_key_pool
+from Key_Pool import RateLimitExceeded, API_WORKERS
+from Bot_Logging import setup_logging, request_id_var
+from Usage_Ledger import UsageLedger, BUDGETS
+from Model_Router import ModelRouter, FAST_MODEL, STRONG_MODEL
+from Emoji_Index import EmojiIndex
+from Semantic_Cache import SemanticCache
+import Traffic_Recorder as traces
+from Drain_Mode import DrainController, DRAIN_TIMEOUT_SECONDS, INTERACTION_TOKEN_LIFETIME
+from Bot_Logging import shutdown_logging
+from Image_Processing import process_image, start_pool, upload_target, IMAGE_QUALITY_PRESET
+from Bulk_Delete import bulk_delete, hours_ago, DeleteProgress, CLEAR_MAX_MESSAGES, CLEAR_SCAN_FACTOR
+from Batch_Prompts import (BatchInputError, parse_inline, parse_file, validate_prompts, format_results,
+                           BATCH_CONCURRENCY, BATCH_MAX_FILE_BYTES)
+from Code_Chunker import chunk_code, CodeChunk, CODE_MAX_CHUNKS, CODE_MAX_FILE_BYTES, CODE_CHUNK_CONCURRENCY, CHARS_PER_TOKEN
 import json
 from datetime import datetime, timedelta
 import time
 import asyncio
 import logging
 import math # Import math for ceiling division
+import contextvars
+import signal
+import io
+import concurrent.futures
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+# Fork the image processing workers first, while this is the process's only thread (see Image_Processing.py)
+image_pool = start_pool()
+
+# Configure queue-backed structured logging (see Bot_Logging.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
@@ -25,8 +48,8 @@ warnings = [] # Stores warnings about missing optional features
 
 token = os.getenv("BOT_TOKEN")
 owner_id_str = os.getenv("OWNER_ID")
-gpt_key = os.getenv("GPT_API_KEY")
-openrouter_deepseek_key = os.getenv("OPENROUTER_DEEPSEEK_API_KEY") # Load the Deepseek key
+gpt_key = os.getenv("GPT_API_KEY") or os.getenv("GPT_API_KEYS") # Single key or a comma separated pool
+openrouter_deepseek_key = os.getenv("OPENROUTER_DEEPSEEK_API_KEY") or os.getenv("OPENROUTER_DEEPSEEK_API_KEYS") # Load the Deepseek key(s)
 discord_server_1_str = os.getenv("DISCORD_SERVER_1")
 discord_server_2_str = os.getenv("DISCORD_SERVER_2") # Optional
 
@@ -49,11 +72,11 @@ else:
 
 # Validate GPT_API_KEY (Treating as Required for core functionality)
 if not gpt_key:
-    error_messages.append("CRITICAL: GPT_API_KEY environment variable is not set.")
+    error_messages.append("CRITICAL: GPT_API_KEY (or GPT_API_KEYS) environment variable is not set.")
 
 # Validate OPENROUTER_DEEPSEEK_API_KEY (Optional - Log Warning if missing)
 if not openrouter_deepseek_key:
-    error_messages.append("CRITICAL: OPENROUTER_DEEPSEEK_API_KEY is not set.")
+    error_messages.append("CRITICAL: OPENROUTER_DEEPSEEK_API_KEY (or OPENROUTER_DEEPSEEK_API_KEYS) is not set.")
 # else:
 #     # Optional: Log confirmation that the key was found
 #     logger.info("OPENROUTER_DEEPSEEK_API_KEY found.")
@@ -115,6 +138,46 @@ except (KeyError, IndexError, json.JSONDecodeError) as e:
     sys.exit("Exiting due to invalid configuration file format.")
 
 
+# Usage ledger for per-user/guild token and image accounting (see Usage_Ledger.py)
+usage_ledger = UsageLedger()
+
+# Picks models for commands and tracks per-model latency/errors (see Model_Router.py)
+model_router = ModelRouter()
+
+# Local word to emoji index that answers /gpt_text_to_emoji without an API call when it can (see Emoji_Index.py)
+emoji_index = EmojiIndex()
+
+# Cache that serves near-duplicate /ask_gpt and /ask_deepseek questions without an API call (see Semantic_Cache.py)
+semantic_cache = SemanticCache()
+
+# Opt-in recorder of anonymized command traces, enabled by TRAFFIC_CAPTURE_PATH (see Traffic_Recorder.py)
+traffic_recorder = traces.TrafficRecorder()
+
+
+# Tracks in-flight API jobs for graceful restarts (see Drain_Mode.py)
+drain_controller = DrainController()
+
+# API functions by name, used to redo checkpointed jobs after a restart
+API_FUNCTIONS = {func.__name__: func for func in (gpt, deepseek, dalle3, dalle2)}
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected while running
+background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Starts a background task and keeps a reference to it until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def start_trace(interaction: discord.Interaction, prompt_chars: int = 0) -> traces.TraceSpan:
+    """Starts a traffic trace for the current command."""
+    command_name = interaction.command.name if interaction.command else "unknown"
+    return traffic_recorder.start(command_name, prompt_chars, interaction.user.id)
+
+
 # --- Help Command Pagination View ---
 class HelpView(ui.View):
     def __init__(self, *, commands: list, items_per_page: int, interaction: discord.Interaction):
@@ -232,24 +295,59 @@ class HelpView(ui.View):
 # --- End Help Command Pagination View ---
 
 
+# --- Clear Command Cancel View ---
+class ClearView(ui.View):
+    def __init__(self, *, interaction: discord.Interaction, cancelled: asyncio.Event):
+        super().__init__(timeout=None) # Lives as long as the clear runs
+        self.interaction = interaction
+        self.cancelled = cancelled
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Only the user who started the clear can cancel it
+        if interaction.user.id != self.interaction.user.id:
+            await interaction.response.send_message("You cannot cancel this clear.", ephemeral=True)
+            return False
+        return True
+
+    @ui.button(label="Cancel", style=discord.ButtonStyle.red, custom_id="cancel_clear")
+    async def cancel(self, interaction: discord.Interaction, button: ui.Button):
+        self.cancelled.set()
+        button.disabled = True
+        button.label = "Cancelling..."
+        await interaction.response.edit_message(view=self)
+
+# --- End Clear Command Cancel View ---
+
+
 class MyClient(discord.Client):
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
 
-    # Optional: Uncomment and adjust setup_hook if you want auto-syncing on startup
-    # async def setup_hook(self):
-    #     logger.info(f"Copying global commands to guild {discord_server_1.id}...")
-    #     self.tree.copy_global_to(guild=discord_server_1)
-    #     await self.tree.sync(guild=discord_server_1)
-    #     logger.info(f"Synced commands to guild {discord_server_1.id}.")
-    #
-    #     if discord_server_2: # Only sync to server 2 if it's configured
-    #         logger.info(f"Copying global commands to guild {discord_server_2.id}...")
-    #         self.tree.copy_global_to(guild=discord_server_2)
-    #         await self.tree.sync(guild=discord_server_2)
-    #         logger.info(f"Synced commands to guild {discord_server_2.id}.")
-    #     logger.info("Command sync process completed in setup_hook.")
+    async def setup_hook(self):
+        # Drain gracefully on SIGTERM (e.g. from a process manager during a deploy)
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: spawn(drain_and_close("SIGTERM"))
+            )
+        except (NotImplementedError, RuntimeError): # Not supported on Windows
+            logger.info("SIGTERM handler not supported on this platform, use /shutdown to drain.")
+
+        # Pick up jobs checkpointed by an instance that is shutting down
+        spawn(watch_drain_checkpoints())
+
+        # Optional: Uncomment and adjust if you want auto-syncing on startup
+        # logger.info(f"Copying global commands to guild {discord_server_1.id}...")
+        # self.tree.copy_global_to(guild=discord_server_1)
+        # await self.tree.sync(guild=discord_server_1)
+        # logger.info(f"Synced commands to guild {discord_server_1.id}.")
+        #
+        # if discord_server_2: # Only sync to server 2 if it's configured
+        #     logger.info(f"Copying global commands to guild {discord_server_2.id}...")
+        #     self.tree.copy_global_to(guild=discord_server_2)
+        #     await self.tree.sync(guild=discord_server_2)
+        #     logger.info(f"Synced commands to guild {discord_server_2.id}.")
+        # logger.info("Command sync process completed in setup_hook.")
 
 
 intents = discord.Intents.default()
@@ -350,13 +448,14 @@ async def sync(interaction: discord.Interaction):
 # -------------------------- HELP COMMAND (PAGINATED) ----------------------------------
 @client.tree.command(name="help", description="Lists all available slash commands")
 async def help_command(interaction: discord.Interaction):
+    trace = start_trace(interaction)
     try:
         # Get all registered commands
         all_commands = client.tree.get_commands()
 
         # Filter out owner-only commands if the user is not the owner
         if interaction.user.id != owner_uid:
-            commands_to_show = [cmd for cmd in all_commands if cmd.name not in ["sync", "shutdown"]]
+            commands_to_show = [cmd for cmd in all_commands if cmd.name not in ["sync", "shutdown", "cache_stats"]]
         else:
             commands_to_show = all_commands # Owner sees all commands
 
@@ -378,9 +477,11 @@ async def help_command(interaction: discord.Interaction):
 
         # Send the initial message with the first page and the view
         await interaction.response.send_message(embed=first_page_embed, view=view, ephemeral=False) # Make help visible
+        trace.finish(traces.LOCAL)
 
     except Exception as e:
         logger.exception("Error occurred in help command:")
+        trace.finish(traces.ERROR)
         # Avoid sending again if already responded/deferred
         if not interaction.response.is_done():
             await interaction.response.send_message("An error occurred while fetching the command list.", ephemeral=True)
@@ -391,9 +492,11 @@ async def help_command(interaction: discord.Interaction):
 # -------------------------- TEST COMMAND ----------------------------------
 @client.tree.command(name="test_bot", description="Replies with 'Hello!'")
 async def running_test(interaction: discord.Interaction):
+    trace = start_trace(interaction)
     await interaction.response.send_message(
         f"Hello, {interaction.user.mention}!", ephemeral=True
     )
+    trace.finish(traces.LOCAL)
 
 
 # -------------------------- SHUTDOWN ----------------------------------
@@ -402,9 +505,15 @@ async def running_test(interaction: discord.Interaction):
 )
 async def shutdown_bot(interaction: discord.Interaction):
     if interaction.user.id == owner_uid:
-        logger.warning(f"Shutdown command received from owner (ID: {interaction.user.id}). Shutting down.")
-        await interaction.response.send_message("Shutting down...", ephemeral=True)
-        await client.close()
+        logger.warning(f"Shutdown command received from owner (ID: {interaction.user.id}). Draining and shutting down.")
+        if drain_controller.draining:
+            await interaction.response.send_message("Already shutting down.", ephemeral=True)
+            return
+        await interaction.response.send_message(
+            f"Shutting down... Finishing {len(drain_controller.jobs)} in-flight requests first (up to {DRAIN_TIMEOUT_SECONDS:g}s).",
+            ephemeral=True
+        )
+        await drain_and_close(f"/shutdown by {interaction.user.id}")
     else:
         logger.warning(f"Unauthorized shutdown attempt by user (ID: {interaction.user.id}).")
         await interaction.response.send_message(
@@ -412,31 +521,233 @@ async def shutdown_bot(interaction: discord.Interaction):
         )
 
 
+# --- Drain mode helpers ---
+def flush_state():
+    """Flushes caches, ledgers and traces to disk. Blocking, run in an executor from async code."""
+    usage_ledger.close() # Flush pending usage entries and rollups
+    emoji_index.save() # Save learned emoji words
+    traffic_recorder.close() # Flush pending traffic traces
+
+
+async def drain_and_close(reason: str):
+    """
+    Stops admitting API commands and waits for in-flight jobs up to DRAIN_TIMEOUT_SECONDS. Jobs still
+    waiting for their API call at the deadline are handed off to another instance, jobs whose API call is
+    already running are waited for (for as long as their interaction can still be answered) and answered
+    here. Then flushes state and disconnects.
+    """
+    if drain_controller.draining:
+        return
+    logger.warning(f"Draining before shutdown ({reason}).")
+    drain_controller.start()
+    try:
+        await client.change_presence(status=discord.Status.idle, activity=discord.Game(name="Restarting..."))
+    except Exception as e:
+        logger.warning(f"Could not update presence while draining: {e}")
+
+    if await drain_controller.wait_idle(DRAIN_TIMEOUT_SECONDS):
+        logger.info("All in-flight jobs finished.")
+    else:
+        handed_off = drain_controller.hand_off()
+        try:
+            await run_blocking(drain_controller.checkpoint, handed_off)
+        except OSError as e:
+            logger.error(f"Failed to checkpoint {len(handed_off)} unstarted jobs: {e}")
+        if drain_controller.jobs:
+            logger.warning(f"Waiting for {len(drain_controller.jobs)} jobs whose API call is already running.")
+            if not await drain_controller.wait_idle(INTERACTION_TOKEN_LIFETIME):
+                logger.error(f"Gave up on {len(drain_controller.jobs)} jobs, their interactions have expired.")
+
+    await run_blocking(flush_state)
+    logger.warning("Drain complete, disconnecting.")
+    await client.close()
+
+
+async def watch_drain_checkpoints():
+    """Periodically claims jobs checkpointed by a draining instance and completes them."""
+    while not client.is_closed() and not drain_controller.draining:
+        for job in await run_blocking(drain_controller.claim_checkpoints):
+            spawn(resume_job(job))
+        await asyncio.sleep(5)
+
+
+def new_job(interaction: discord.Interaction, kind: str, api_func, args: tuple, kwargs: dict, title: str) -> dict:
+    """Describes an API job so another instance can redo it and answer through the interaction's followup webhook."""
+    return {
+        "kind": kind,
+        "api": api_func.__name__,
+        "args": list(args),
+        "kwargs": kwargs,
+        "title": title,
+        "command": interaction.command.name if interaction.command else "unknown",
+        "user_id": interaction.user.id,
+        "guild_id": interaction.guild_id,
+        "application_id": interaction.application_id,
+        "token": interaction.token,
+        "interaction_id": interaction.id,
+    }
+
+
+async def admit_job(interaction: discord.Interaction, job: dict) -> bool:
+    """Registers an in-flight job. If the bot is draining, sends a notice and returns False."""
+    if drain_controller.begin(interaction.id, job):
+        return True
+    await interaction.response.send_message(
+        "The bot is restarting and isn't taking new requests right now. Please try again in a minute.", ephemeral=True
+    )
+    return False
+
+
+async def resume_job(job: dict):
+    """Redoes a job checkpointed by another instance and sends the result as the interaction's followup."""
+    job_id = job.get("interaction_id") or id(job)
+    if not drain_controller.begin(job_id, job):
+        # This instance started draining after claiming the job, put it back for another instance
+        await run_blocking(drain_controller.checkpoint, [job])
+        return
+    # Redone right away, so a drain waits for it instead of handing it off again
+    job.update(started=True, resumable=False)
+    webhook = discord.Webhook.partial(job["application_id"], job["token"], client=client)
+    api_func = API_FUNCTIONS.get(job["api"])
+    try:
+        if api_func is None:
+            raise ValueError(f"Unknown API function '{job['api']}'")
+        usage = {}
+        start_time = time.monotonic()
+        result = await run_api(api_func, *job["args"], usage=usage, **job["kwargs"])
+        usage_ledger.record(
+            job["user_id"], job["guild_id"], job["command"], usage.get("model"),
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            images=usage.get("images", 0),
+            latency_ms=round((time.monotonic() - start_time) * 1000),
+        )
+        if not result:
+            await webhook.send("The API returned an empty response. Please try again.")
+            return
+        if job["kind"] == "image":
+            embed = discord.Embed(title=job["title"], description=f"[Image Link]({result})", color=discord.Color.purple())
+            embed.set_image(url=result)
+        else:
+            embed = build_response_embed(job["title"], result)
+        embed.set_footer(text="Completed after a bot restart")
+        await webhook.send(embed=embed)
+        logger.info(f"Completed checkpointed job for /{job['command']}.")
+    except Exception:
+        logger.exception(f"Failed to complete checkpointed job for /{job['command']}:")
+        try:
+            await webhook.send("Your request could not be completed during a bot restart. Please try again.")
+        except discord.HTTPException as http_err:
+            logger.error(f"Failed to send checkpointed job error followup: {http_err}")
+    finally:
+        drain_controller.end(job_id)
+
+
 # -------------------------- DELETE MESSAGES ----------------------------------
+active_clears = {} # channel ID -> cancel event of the running /clear
+
+def format_clear_progress(progress: DeleteProgress, status: str) -> str:
+    text = (f"{status} {progress.deleted:,}/{progress.limit:,} deleted, "
+            f"{progress.scanned:,} messages checked ({progress.elapsed:.0f}s).")
+    if progress.single_deleted:
+        text += "\nMessages older than 14 days are deleted one at a time, so this can take a while."
+    if progress.failed:
+        text += f"\n{progress.failed:,} messages could not be deleted."
+    return text
+
+
 @client.tree.command(
     name="clear",
-    description="Deletes a specified number of messages from the current channel.",
+    description="Deletes messages from the current channel, optionally filtered by author or age.",
 )
 @app_commands.checks.has_permissions(manage_messages=True) # Use decorator for permissions
-@app_commands.describe(amount="Number of messages to delete (1-100)")
-async def clear_messages(interaction: discord.Interaction, amount: app_commands.Range[int, 1, 100]): # Use Range for validation, renamed function
+@app_commands.describe(
+    amount=f"Number of messages to delete (1-{CLEAR_MAX_MESSAGES})",
+    user="Only delete messages from this user",
+    newer_than_hours="Only delete messages newer than this many hours",
+    older_than_hours="Only delete messages older than this many hours",
+)
+async def clear_messages(
+    interaction: discord.Interaction,
+    amount: app_commands.Range[int, 1, CLEAR_MAX_MESSAGES], # Use Range for validation, renamed function
+    user: discord.User | None = None,
+    newer_than_hours: app_commands.Range[int, 1, 24 * 365] | None = None,
+    older_than_hours: app_commands.Range[int, 1, 24 * 365] | None = None,
+):
+    trace = start_trace(interaction)
+    channel = interaction.channel
+    if channel.id in active_clears:
+        await interaction.response.send_message("A clear is already running in this channel.", ephemeral=True)
+        trace.finish(traces.REJECTED)
+        return
+    if newer_than_hours and older_than_hours and newer_than_hours <= older_than_hours:
+        await interaction.response.send_message("`newer_than_hours` must be larger than `older_than_hours`.", ephemeral=True)
+        trace.finish(traces.REJECTED)
+        return
+
     await interaction.response.defer(ephemeral=True, thinking=True)
+    cancelled = asyncio.Event()
+    active_clears[channel.id] = cancelled
+    view = ClearView(interaction=interaction, cancelled=cancelled)
+    can_edit = True # False once the interaction token has expired (15 minutes)
+
+    async def show_progress(progress: DeleteProgress):
+        nonlocal can_edit
+        if not can_edit:
+            return
+        try:
+            await interaction.edit_original_response(content=format_clear_progress(progress, "Deleting..."), view=view)
+        except discord.HTTPException as e:
+            can_edit = False
+            logger.warning(f"Stopped /clear progress updates in channel {channel.id}: {e.status} {e.text}")
+
+    # Message text isn't available without the privileged message content intent, so filters use the author only
+    def matches(message: discord.Message) -> bool:
+        return message.author.id == user.id
+
     try:
-        deleted = await interaction.channel.purge(limit=amount)
+        await interaction.edit_original_response(content="Looking for messages to delete...", view=view)
+        progress = await bulk_delete(
+            channel, amount,
+            check=matches if user else None,
+            max_scanned=amount * CLEAR_SCAN_FACTOR if user else None,
+            before=hours_ago(older_than_hours),
+            after=hours_ago(newer_than_hours),
+            cancelled=cancelled,
+            on_progress=show_progress,
+        )
         timestamp = discord.utils.format_dt(datetime.now(), style='F') # Formatted timestamp
-        await interaction.followup.send(
-            f"Successfully deleted {len(deleted)} messages. ({timestamp})", ephemeral=True
+        if cancelled.is_set():
+            status = "Cancelled."
+        elif progress.scan_limit_reached:
+            status = f"Stopped after checking {progress.scanned:,} messages."
+        else:
+            status = "Done."
+        if can_edit:
+            await interaction.edit_original_response(
+                content=f"{format_clear_progress(progress, status)} ({timestamp})", view=None
+            )
+        logger.info(
+            f"User {interaction.user} cleared {progress.deleted} messages in channel {channel.id} "
+            f"({progress.bulk_deleted} bulk, {progress.single_deleted} single, {progress.failed} failed, "
+            f"{progress.scanned} checked, {progress.elapsed:.0f}s{', cancelled' if cancelled.is_set() else ''})."
         )
-        logger.info(f"User {interaction.user} cleared {len(deleted)} messages in channel {interaction.channel.id}.")
+        trace.finish(traces.LOCAL)
     except discord.Forbidden:
-        logger.warning(f"Bot lacks 'Manage Messages' permission in channel {interaction.channel.id} for clear command.")
+        logger.warning(f"Bot lacks 'Manage Messages' permission in channel {channel.id} for clear command.")
         await interaction.followup.send("I don't have permission to delete messages in this channel.", ephemeral=True)
+        trace.finish(traces.ERROR)
     except discord.HTTPException as e:
         logger.error(f"HTTPException during message purge: {e.status} {e.text}")
         await interaction.followup.send("An error occurred while trying to delete messages.", ephemeral=True)
+        trace.finish(traces.ERROR)
     except Exception as e:
         logger.exception("Unexpected error during clear command:")
         await interaction.followup.send("An unexpected error occurred.", ephemeral=True)
+        trace.finish(traces.ERROR)
+    finally:
+        active_clears.pop(channel.id, None)
+        view.stop()
 
 # Error handler for the clear command specifically for permission issues
 @clear_messages.error
@@ -455,6 +766,7 @@ async def clear_messages_error(interaction: discord.Interaction, error: app_comm
 # -------------------------- BOT LATENCY ----------------------------------
 @client.tree.command(name="ping", description="Checks the bot's latency")
 async def ping(interaction: discord.Interaction):
+    trace = start_trace(interaction)
     try:
         start_time = time.monotonic()
         # Defer first to acknowledge the command quickly
@@ -468,8 +780,10 @@ async def ping(interaction: discord.Interaction):
             f"Pong! \nWebsocket Latency: {latency}ms\nInteraction Latency: {interaction_latency}ms",
              ephemeral=True
         )
+        trace.finish(traces.LOCAL)
     except Exception as e:
         logger.exception("Error occurred in ping command:")
+        trace.finish(traces.ERROR)
         # Avoid sending again if already responded/deferred
         if not interaction.response.is_done():
             await interaction.response.send_message("An error occurred while measuring latency.", ephemeral=True)
@@ -477,44 +791,140 @@ async def ping(interaction: discord.Interaction):
             await interaction.followup.send("An error occurred while measuring latency.", ephemeral=True)
 
 
+# --- Helper for running blocking calls ---
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """
+    Runs a blocking function in the default executor (or `executor`), carrying over context (e.g. the request ID
+    for logging).
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+
+# Upstream API calls get their own threads: they can wait up to KEY_POOL_WAIT_SECONDS for a key
+api_executor = concurrent.futures.ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api")
+
+
+async def run_api(func, *args, **kwargs):
+    """Runs a blocking upstream API call in the API executor, carrying over context like run_blocking."""
+    return await run_blocking(func, *args, executor=api_executor, **kwargs)
+
+
+# --- Helpers for usage accounting ---
+async def reject_over_budget(interaction: discord.Interaction, tokens: int = 0, images: int = 0) -> bool:
+    """Checks usage budgets for the user and guild. Sends a notice and returns True if the request should not go upstream."""
+    if interaction.user.id == owner_uid: # Owner is exempt from budgets
+        return False
+    message = usage_ledger.check_budget(interaction.user.id, interaction.guild_id, tokens=tokens, images=images)
+    if message is None:
+        return False
+    logger.info(f"Budget exceeded for user {interaction.user.id} in guild {interaction.guild_id}: {message}")
+    if interaction.response.is_done(): # Already deferred
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
+    return True
+
+
+def record_usage(interaction: discord.Interaction, usage: dict, start_time: float):
+    """Records the usage reported by an API function in the usage ledger."""
+    usage_ledger.record(
+        interaction.user.id,
+        interaction.guild_id,
+        interaction.command.name if interaction.command else "unknown",
+        usage.get("model"),
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        completion_tokens=usage.get("completion_tokens", 0),
+        images=usage.get("images", 0),
+        latency_ms=round((time.monotonic() - start_time) * 1000),
+    )
+
+
 # --- Helper Function for API Commands ---
-async def handle_api_command(interaction: discord.Interaction, title: str, api_func, *args):
-    """Handles common logic for API commands: defer, call API, format embed, send response, handle errors."""
+def prompt_from_args(api_func, args: tuple) -> str:
+    """Returns the user's prompt from an API function's positional args (deepseek takes it first, gpt takes the model first)."""
+    index = 0 if api_func is deepseek else 1
+    return args[index] if len(args) > index and isinstance(args[index], str) else ""
+
+
+def build_response_embed(title: str, text: str) -> discord.Embed:
+    """Builds the standard embed used to present a text response."""
+    # Check response length against Discord limits (Embed description limit is 4096)
+    if len(text) > 4096:
+        logger.warning(f"API response exceeded 4096 characters for {title}. Truncating.")
+        text = text[:4093] + "..." # Truncate safely
+
+    embed = discord.Embed(
+        title=title,
+        description=text,
+        color=discord.Color.blue(),
+    )
+    avatar_url = client.user.avatar.url if client.user.avatar else None
+    embed.set_author(
+        name=client.user.name,
+        icon_url=avatar_url,
+    )
+    # Optionally add timestamp or footer
+    embed.timestamp = datetime.now()
+    return embed
+
+
+async def handle_api_command(interaction: discord.Interaction, title: str, api_func, *args, on_response=None,
+                             trace: traces.TraceSpan | None = None):
+    """
+    Handles common logic for API commands: defer, call API, format embed, send response, handle errors.
+    `on_response` is an optional callback that receives the API response text, e.g. to learn from it.
+    `trace` is the command's span if the command started it earlier (e.g. before a local lookup).
+    """
+    request_id_var.set(interaction.id) # Tag all logs for this command (including executor threads)
+    prompt = prompt_from_args(api_func, args)
+    trace = trace or start_trace(interaction, len(prompt))
+
+    # Enforce usage budgets before going upstream (rough estimate of 4 characters per token)
+    estimated_tokens = sum(len(arg) for arg in args if isinstance(arg, str)) // 4
+    if await reject_over_budget(interaction, tokens=estimated_tokens):
+        trace.finish(traces.REJECTED)
+        return
+
+    # Refuse new work while draining for a restart, otherwise track the job until it finishes
+    if not await admit_job(interaction, new_job(interaction, "text", api_func, args, {}, title)):
+        trace.finish(traces.REJECTED)
+        return
+
+    command_name = interaction.command.name if interaction.command else "unknown" # Router stats are per command
+    usage = {}
+    start_time = time.monotonic()
+    upstream_ms = None
     try:
         # Use thinking=True for potentially long API calls
         await interaction.response.defer(ephemeral=False, thinking=True)
 
-        # Run the blocking API call in an executor
-        loop = asyncio.get_event_loop()
-        api_response = await loop.run_in_executor(None, api_func, *args)
+        # Run the blocking API call in the API executor (marks the job as started, so a restart never hands it off)
+        start_time = time.monotonic()
+        api_response = await run_api(drain_controller.run_job, interaction.id, api_func, *args, usage=usage)
+        upstream_ms = (time.monotonic() - start_time) * 1000
+        record_usage(interaction, usage, start_time)
+        model_router.observe(command_name, usage.get("model"), upstream_ms, ok=True)
 
         if not api_response:
-             logger.warning(f"API call {api_func.__name__} returned empty response for prompt: {args[1] if len(args) > 1 else 'N/A'}")
+             logger.warning(f"API call {api_func.__name__} returned empty response for prompt: {prompt}")
              await interaction.followup.send("The API returned an empty response. Please try again.", ephemeral=True)
+             trace.finish(traces.EMPTY, upstream_ms)
              return
 
-        # Check response length against Discord limits (Embed description limit is 4096)
-        if len(api_response) > 4096:
-            logger.warning(f"API response exceeded 4096 characters for {title}. Truncating.")
-            api_response = api_response[:4093] + "..." # Truncate safely
-
-        embed = discord.Embed(
-            title=title,
-            description=api_response,
-            color=discord.Color.blue(),
-        )
-        avatar_url = client.user.avatar.url if client.user.avatar else None
-        embed.set_author(
-            name=client.user.name,
-            icon_url=avatar_url,
-        )
-        # Optionally add timestamp or footer
-        embed.timestamp = datetime.now()
+        if on_response:
+            on_response(api_response)
 
-        await interaction.followup.send(embed=embed)
+        await interaction.followup.send(embed=build_response_embed(title, api_response))
+        trace.finish(traces.OK, upstream_ms)
 
     except Exception as e:
         logger.exception(f"Error occurred in API command '{title}':")
+        if upstream_ms is None:
+            upstream_ms = (time.monotonic() - start_time) * 1000
+            model_router.observe(command_name, usage.get("model"), upstream_ms, ok=False)
+        trace.finish(traces.ERROR, upstream_ms)
         error_message_user = "An error occurred while processing your request."
         # Check for specific OpenAI content policy violation format if applicable
         # (Adjust this based on the actual error structure from the OpenAI library)
@@ -525,6 +935,8 @@ async def handle_api_command(interaction: discord.Interaction, title: str, api_f
                  error_message_user = f"Content Policy Violation: {details}"
              except IndexError:
                  error_message_user = "Your request was flagged due to content policy."
+        elif isinstance(e, (openai.RateLimitError, RateLimitExceeded)): # Every pooled key is rate limited
+             error_message_user = "Rate limit reached. Please try again later."
 
         # Use followup.send since we deferred
         try:
@@ -533,6 +945,33 @@ async def handle_api_command(interaction: discord.Interaction, title: str, api_f
              logger.error("Interaction expired before error message could be sent.")
         except discord.HTTPException as http_err:
              logger.error(f"Failed to send error followup: {http_err}")
+    finally:
+        drain_controller.end(interaction.id)
+
+
+# --- Helper for cached general questions ---
+async def send_cached_answer(interaction: discord.Interaction, scope: str, title: str, prompt: str,
+                             trace: traces.TraceSpan) -> bool:
+    """
+    Sends a cached answer to a near-duplicate question if there is one. Returns True if the question was answered,
+    otherwise the command's trace is left running for the API call.
+    """
+    cached = semantic_cache.get(scope, prompt)
+    if cached is None:
+        return False
+    response, similarity = cached
+    logger.info("semantic_cache_hit", extra={"event": "semantic_cache_hit", "scope": scope, "similarity": round(similarity, 3), **semantic_cache.stats()})
+    embed = build_response_embed(title, response)
+    embed.set_footer(text="Answered from a similar earlier question")
+    await interaction.response.send_message(embed=embed)
+    trace.finish(traces.CACHED)
+    return True
+
+
+def cache_scope(interaction: discord.Interaction, *parts: str) -> str:
+    """Builds a semantic cache scope, so answers are only shared within the same guild (or DM) and command/model."""
+    location = f"g{interaction.guild_id}" if interaction.guild_id else f"dm{interaction.user.id}"
+    return ":".join((location, *parts))
 
 
 # -------------------------- CORRECT GRAMMAR ----------------------------------
@@ -544,7 +983,8 @@ async def gpt_correct_grammar(interaction: discord.Interaction, text: str): # Re
     # Safely get system prompt, provide default if missing
     sys_prompt_base = data.get("system_content", [{}])[0].get("correct_grammar", "Correct the grammar:")
     sys_prompt = sys_prompt_base + char_limit
-    await handle_api_command(interaction, "Corrected Grammar", gpt, "gpt-3.5-turbo-16k", text, sys_prompt, 0)
+    model = model_router.model_for("gpt_correct_grammar", text)
+    await handle_api_command(interaction, "Corrected Grammar", gpt, model, text, sys_prompt, 0)
 
 
 # -------------------------- WEBSITE ----------------------------------
@@ -556,21 +996,44 @@ async def gpt_correct_grammar(interaction: discord.Interaction, text: str): # Re
 async def gpt_single_page_website(interaction: discord.Interaction, specifications: str): # Renamed function
     sys_prompt_base = data.get("system_content", [{}])[0].get("single_page_website", "Create a single page website:")
     sys_prompt = sys_prompt_base + char_limit
-    await handle_api_command(interaction, "Single Page Website Code", gpt, "gpt-3.5-turbo-16k", specifications, sys_prompt, 0.7)
+    model = model_router.model_for("gpt_single_page_website", specifications)
+    await handle_api_command(interaction, "Single Page Website Code", gpt, model, specifications, sys_prompt, 0.7)
 
 
 # -------------------------- TEXT TO EMOJI ----------------------------------
+emoji_save_task = None # Background save of learned emoji words, see learn_emojis
+
+
 @client.tree.command(name = "gpt_text_to_emoji", description = "Converts text to emojis")
 @app_commands.describe(text = "Text to convert to emojis (max 230 chars)")
 async def gpt_text_to_emoji(interaction: discord.Interaction, text: str): # Renamed function
+    trace = start_trace(interaction, len(text))
     if len(text) > 230:
         await interaction.response.send_message(
             "Input text is too long (max 230 characters).", ephemeral=True
         )
+        trace.finish(traces.REJECTED)
+        return
+
+    title = f'Text to Emoji for "{text}"'
+    # Answer locally if every word is already in the emoji index
+    local_response = emoji_index.lookup(text)
+    if local_response:
+        logger.info(f"Text to emoji answered from local index ({emoji_index.hits} hits, {emoji_index.misses} misses).")
+        await interaction.response.send_message(embed=build_response_embed(title, local_response))
+        trace.finish(traces.LOCAL)
         return
 
+    def learn_emojis(response: str):
+        global emoji_save_task
+        emoji_index.learn(text, response)
+        if emoji_index.pending_changes >= 20 and (emoji_save_task is None or emoji_save_task.done()):
+            # Save in the background so the event loop doesn't wait on disk I/O, one save at a time
+            emoji_save_task = spawn(run_blocking(emoji_index.save))
+
     sys_prompt = data.get("system_content", [{}])[0].get("text_to_emoji", "Convert to emojis:")
-    await handle_api_command(interaction, f'Text to Emoji for "{text}"', gpt, "gpt-3.5-turbo-16k", text, sys_prompt, 0.7)
+    model = model_router.model_for("gpt_text_to_emoji", text)
+    await handle_api_command(interaction, title, gpt, model, text, sys_prompt, 0.7, on_response=learn_emojis, trace=trace)
 
 
 # -------------------------- TEXT TO BLOCK LETTERS ----------------------------------
@@ -580,16 +1043,152 @@ async def gpt_text_to_emoji(interaction: discord.Interaction, text: str): # Rena
 @app_commands.describe(text = "Text to convert into block letters")
 async def gpt_text_to_block_letters(interaction: discord.Interaction, text: str): # Renamed function
     sys_prompt = data.get("system_content", [{}])[0].get("text_to_block_letters", "Convert to block letters:")
-    await handle_api_command(interaction, "Text to Block Letters", gpt, "gpt-3.5-turbo-16k", text, sys_prompt, 0.7)
+    model = model_router.model_for("gpt_text_to_block_letters", text)
+    await handle_api_command(interaction, "Text to Block Letters", gpt, model, text, sys_prompt, 0.7)
 
 
 # -------------------------- CODE DEBUG ----------------------------------
+async def download_attachment(attachment: discord.Attachment, max_bytes: int) -> bytes:
+    """Streams an attachment into memory. Raises ValueError if it's larger than max_bytes."""
+    if attachment.size > max_bytes:
+        raise ValueError(f"The file is too large (max {format_bytes(max_bytes)}).")
+    buffer = bytearray()
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for block in response.content.iter_chunked(64 * 1024):
+                buffer.extend(block)
+                if len(buffer) > max_bytes: # Don't trust the reported size alone
+                    raise ValueError(f"The file is too large (max {format_bytes(max_bytes)}).")
+    return bytes(buffer)
+
+
+# Threads for the parts of /gpt_debug_code file analyses, room for two files at full concurrency
+code_executor = concurrent.futures.ThreadPoolExecutor(max_workers=CODE_CHUNK_CONCURRENCY * 2, thread_name_prefix="code-debug")
+
+
+async def handle_code_file(interaction: discord.Interaction, file: discord.Attachment):
+    """
+    Debugs an uploaded code file: splits it into chunks that fit the model's context, analyzes the chunks
+    in parallel and merges their reports into one. Reports too long for an embed are sent as a file.
+    """
+    request_id_var.set(interaction.id) # Tag all logs for this command (including executor threads)
+    trace = start_trace(interaction, file.size)
+    title = f"Code Debug Analysis for {file.filename}"
+    if file.size > CODE_MAX_FILE_BYTES:
+        await interaction.response.send_message(f"The file is too large (max {format_bytes(CODE_MAX_FILE_BYTES)}).", ephemeral=True)
+        trace.finish(traces.REJECTED)
+        return
+    if await reject_over_budget(interaction, tokens=file.size // CHARS_PER_TOKEN):
+        trace.finish(traces.REJECTED)
+        return
+    # A multi-part analysis can't be redone after a restart, so drain mode waits for it instead
+    job = new_job(interaction, "code_file", gpt, (), {}, title)
+    job["resumable"] = False
+    if not await admit_job(interaction, job):
+        trace.finish(traces.REJECTED)
+        return
+
+    start_time = time.monotonic()
+    try:
+        await interaction.response.defer(ephemeral=False, thinking=True)
+        try:
+            code = (await download_attachment(file, CODE_MAX_FILE_BYTES)).decode("utf-8-sig")
+        except UnicodeDecodeError:
+            raise ValueError("The file must be UTF-8 text.")
+        chunks = chunk_code(code, file.filename)
+        if not chunks:
+            raise ValueError("The file is empty.")
+        if len(chunks) > CODE_MAX_CHUNKS:
+            raise ValueError(f"The file is too large to analyze ({len(chunks)} parts, max {CODE_MAX_CHUNKS}).")
+
+        system_prompts = data.get("system_content", [{}])[0]
+        model = model_router.model_for("gpt_debug_code", code)
+        total_lines = chunks[-1].end_line
+        # Keep each part's report short enough that all of them fit in the merge request
+        part_limit = max(800, 16000 // len(chunks)) if len(chunks) > 1 else 4096
+        part_prompt = system_prompts.get("code_debug", "Debug this code:") + f" Your response must not exceed {part_limit} characters"
+
+        async def call_model(prompt: str, sys_prompt: str):
+            usage = {}
+            call_start = time.monotonic()
+            try:
+                response = await run_blocking(gpt, model, prompt, sys_prompt, 0, usage=usage, executor=code_executor)
+            except Exception:
+                model_router.observe("gpt_debug_code", usage.get("model"), (time.monotonic() - call_start) * 1000, ok=False)
+                raise
+            model_router.observe("gpt_debug_code", usage.get("model"), (time.monotonic() - call_start) * 1000, ok=True)
+            record_usage(interaction, usage, call_start)
+            return response
+
+        semaphore = asyncio.Semaphore(CODE_CHUNK_CONCURRENCY)
+
+        async def analyze(chunk: CodeChunk) -> str | None:
+            header = f"File: {file.filename}, lines {chunk.start_line}-{chunk.end_line} of {total_lines}\n\n"
+            async with semaphore:
+                try:
+                    return await call_model(header + chunk.text, part_prompt)
+                except Exception as e:
+                    logger.warning(f"Debug analysis of {file.filename} lines {chunk.start_line}-{chunk.end_line} failed: {e}")
+                    return None
+
+        # Up to CODE_CHUNK_CONCURRENCY parts at once (all of them by default), lower it to leave GPT-4 capacity for other commands
+        reports = await asyncio.gather(*(analyze(chunk) for chunk in chunks))
+        if not any(reports):
+            raise RuntimeError("Every part of the analysis failed.")
+        sections = "\n\n".join(
+            f"### Lines {chunk.start_line}-{chunk.end_line}\n\n{report or 'The analysis of this part failed.'}"
+            for chunk, report in zip(chunks, reports)
+        )
+
+        if len(chunks) == 1:
+            final_report = reports[0]
+        else:
+            try:
+                final_report = await call_model(sections, system_prompts.get("code_debug_merge", "Combine these bug reports:"))
+            except Exception as e:
+                logger.warning(f"Merging debug reports for {file.filename} failed, sending the parts instead: {e}")
+                final_report = None
+            final_report = final_report or sections
+        upstream_ms = (time.monotonic() - start_time) * 1000
+
+        if len(final_report) <= 4096:
+            await interaction.followup.send(embed=build_response_embed(title, final_report))
+        else:
+            embed = build_response_embed(title, f"The report is {len(final_report):,} characters long, see the attached file.")
+            report_file = discord.File(io.BytesIO(final_report.encode("utf-8")), filename="debug_report.md")
+            await interaction.followup.send(embed=embed, file=report_file)
+        logger.info(f"Debugged {file.filename} ({total_lines} lines) in {len(chunks)} parts in {upstream_ms:.0f}ms.")
+        trace.finish(traces.OK, upstream_ms)
+
+    except ValueError as e:
+        await interaction.followup.send(str(e), ephemeral=True)
+        trace.finish(traces.REJECTED)
+    except Exception:
+        logger.exception(f"Error occurred while debugging {file.filename}:")
+        trace.finish(traces.ERROR, (time.monotonic() - start_time) * 1000)
+        try:
+            await interaction.followup.send("An error occurred while processing your request.", ephemeral=True)
+        except discord.HTTPException as http_err:
+            logger.error(f"Failed to send error followup: {http_err}")
+    finally:
+        drain_controller.end(interaction.id)
+
+
 @client.tree.command(name = "gpt_debug_code", description="Debugs your code using GPT-4")
-@app_commands.describe(code = "Code snippet to debug")
-async def gpt_debug_code(interaction: discord.Interaction, code: str): # Renamed function
+@app_commands.describe(code = "Code snippet to debug", file = "A code file to debug (large files are analyzed in parts)")
+async def gpt_debug_code(interaction: discord.Interaction, code: str | None = None, file: discord.Attachment | None = None): # Renamed function
+    if bool(code) == bool(file):
+        await interaction.response.send_message("Please provide either a code snippet or a file.", ephemeral=True)
+        return
+    if file:
+        await handle_code_file(interaction, file)
+        return
+
     sys_prompt_base = data.get("system_content", [{}])[0].get("code_debug", "Debug this code:")
     sys_prompt = sys_prompt_base + char_limit
-    await handle_api_command(interaction, "Code Debug Analysis", gpt, "gpt-4", code, sys_prompt, 0)
+    model = model_router.model_for("gpt_debug_code", code)
+    await handle_api_command(interaction, "Code Debug Analysis", gpt, model, code, sys_prompt, 0)
 
 
 # -------------------------- SHORT STORY ----------------------------------
@@ -599,49 +1198,278 @@ async def gpt_debug_code(interaction: discord.Interaction, code: str): # Renamed
 @app_commands.describe(topic = "What should the story be about?")
 async def gpt_short_story(interaction: discord.Interaction, topic: str): # Renamed function
     sys_prompt = data.get("system_content", [{}])[0].get("short_story", "Write a short story:")
-    await handle_api_command(interaction, f'Short Story about "{topic}"', gpt, "gpt-4", topic, sys_prompt, 0.7)
+    model = model_router.model_for("gpt_short_story", topic)
+    await handle_api_command(interaction, f'Short Story about "{topic}"', gpt, model, topic, sys_prompt, 0.7)
 
 
 # -------------------------- GENERAL QUESTION (GPT) ----------------------------------
 # Define choices for the model parameter
-ModelChoices = app_commands.Choice(name="GPT-3.5 (Faster, Cheaper)", value="gpt-3.5-turbo-16k")
-ModelChoices4 = app_commands.Choice(name="GPT-4 (Smarter, Slower)", value="gpt-4")
+ModelChoicesAuto = app_commands.Choice(name="Auto (Picks a model for you)", value="auto")
+ModelChoices = app_commands.Choice(name="GPT-3.5 (Faster, Cheaper)", value=FAST_MODEL)
+ModelChoices4 = app_commands.Choice(name="GPT-4 (Smarter, Slower)", value=STRONG_MODEL)
 
 @client.tree.command(name = "ask_gpt", description = "Ask a general question to GPT") # Renamed command
 @app_commands.describe(prompt = "What do you want to ask? (max 230 chars)")
-@app_commands.describe(model = "Choose the GPT model to use")
-@app_commands.choices(model=[ModelChoices, ModelChoices4]) # Use choices
-async def ask_gpt(interaction: discord.Interaction, prompt: str, model: app_commands.Choice[str]): # Renamed function, use Choice type hint
+@app_commands.describe(model = "Choose the GPT model to use (defaults to Auto)")
+@app_commands.choices(model=[ModelChoicesAuto, ModelChoices, ModelChoices4]) # Use choices
+async def ask_gpt(interaction: discord.Interaction, prompt: str, model: app_commands.Choice[str] = None): # Renamed function, use Choice type hint
+    trace = start_trace(interaction, len(prompt))
     if len(prompt) > 230:
         await interaction.response.send_message(
             "Your question is too long (max 230 characters).", ephemeral=True
         )
+        trace.finish(traces.REJECTED)
         return
 
     sys_prompt = data.get("system_content", [{}])[0].get("general_questions_gpt", "Answer the question:")
-    title = f'GPT ({model.name}) response to "{prompt}"' # Use choice name in title
-    await handle_api_command(interaction, title, gpt, model.value, prompt, sys_prompt, 0.7) # Use choice value for API call
+    requested = model.value if model else None
+    scope = cache_scope(interaction, "ask_gpt", requested or "auto")
+    if await send_cached_answer(interaction, scope, f'GPT response to "{prompt}"', prompt, trace):
+        return
+
+    # Resolve the model, "auto" (or no choice) lets the router pick one
+    model_value = model_router.model_for("ask_gpt", prompt, requested=requested)
+    if model and model.value != "auto":
+        model_name = model.name
+    else:
+        model_name = f"Auto: {model_value}"
+    title = f'GPT ({model_name}) response to "{prompt}"' # Use choice name in title
+    await handle_api_command(interaction, title, gpt, model_value, prompt, sys_prompt, 0.7, # Use resolved model for API call
+                             on_response=lambda response: semantic_cache.put(scope, prompt, response), trace=trace)
 
 
 # -------------------------- GENERAL QUESTION (DEEPSEEK) ----------------------------------
 @client.tree.command(name = "ask_deepseek", description = "Ask a general question to Deepseek") # Renamed command
 @app_commands.describe(prompt = "What do you want to ask? (max 230 chars)")
 async def ask_deepseek(interaction: discord.Interaction, prompt: str): # Renamed function
+    trace = start_trace(interaction, len(prompt))
     if len(prompt) > 230:
          await interaction.response.send_message(
             "Your question is too long (max 230 characters).", ephemeral=True
         )
+         trace.finish(traces.REJECTED)
          return
 
     sys_prompt = data.get("system_content", [{}])[0].get("general_questions_deepseek", "Answer the question:")
     title = f'Deepseek response to "{prompt}"'
+    scope = cache_scope(interaction, "ask_deepseek")
+    if await send_cached_answer(interaction, scope, title, prompt, trace):
+        return
+
     # Note: deepseek function in Chat_GPT_Function.txt needs prompt and sys_prompt args
-    await handle_api_command(interaction, title, deepseek, prompt, sys_prompt)
+    await handle_api_command(interaction, title, deepseek, prompt, sys_prompt,
+                             on_response=lambda response: semantic_cache.put(scope, prompt, response), trace=trace)
+
+
+# -------------------------- BATCH ----------------------------------
+# GPT_Parameters.json prompts that /gpt_batch can run: prompt key -> (command whose model routing it uses, temperature)
+# Prompts not listed here are still offered and use the "gpt_batch" route.
+BATCH_TEMPLATES = {
+    "correct_grammar": ("gpt_correct_grammar", 0),
+    "single_page_website": ("gpt_single_page_website", 0.7),
+    "text_to_emoji": ("gpt_text_to_emoji", 0.7),
+    "text_to_block_letters": ("gpt_text_to_block_letters", 0.7),
+    "code_debug": ("gpt_debug_code", 0),
+    "short_story": ("gpt_short_story", 0.7),
+    "general_questions_gpt": ("ask_gpt", 0.7),
+    "general_questions_deepseek": ("ask_deepseek", 0.7), # Answered by Deepseek
+}
+BatchTemplateChoices = [
+    app_commands.Choice(name=key.replace("_", " ").capitalize(), value=key)
+    for key in data.get("system_content", [{}])[0] if key not in ("character_limit_prompt", "code_debug_merge")
+][:25] # Discord allows at most 25 choices
+
+
+async def read_batch_prompts(prompts: str | None, separator: str, file: discord.Attachment | None) -> list[str]:
+    """Collects batch prompts from the inline text and/or the uploaded file. Raises BatchInputError if they can't be used."""
+    collected = parse_inline(prompts, separator) if prompts else []
+    if file:
+        if file.size > BATCH_MAX_FILE_BYTES:
+            raise BatchInputError(f"The file is too large (max {format_bytes(BATCH_MAX_FILE_BYTES)}).")
+        collected.extend(parse_file(file.filename, await file.read()))
+    validate_prompts(collected)
+    return collected
+
+
+@client.tree.command(name="gpt_batch", description="Runs one prompt template over many inputs and returns a single file")
+@app_commands.describe(
+    template="Which prompt to run each input through",
+    prompts="Inputs separated by the separator (default |)",
+    file="A .txt file with one input per line, or a .jsonl file of strings or {\"prompt\": ...} objects",
+    separator="Separator for inline inputs (default |)",
+)
+@app_commands.choices(template=BatchTemplateChoices)
+async def gpt_batch(interaction: discord.Interaction, template: app_commands.Choice[str], prompts: str | None = None,
+                    file: discord.Attachment | None = None, separator: str = "|"):
+    request_id_var.set(interaction.id) # Tag all logs for this command (including executor threads)
+    trace = start_trace(interaction)
+    # A batch can't be redone after a restart, so drain mode waits for it and then stops starting new prompts
+    job = new_job(interaction, "batch", gpt, (), {}, template.name)
+    job["resumable"] = False
+    if not await admit_job(interaction, job):
+        trace.finish(traces.REJECTED)
+        return
+
+    sys_prompt = data.get("system_content", [{}])[0].get(template.value, "")
+    route, temperature = BATCH_TEMPLATES.get(template.value, ("gpt_batch", 0.7))
+    use_deepseek = route == "ask_deepseek"
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    batch = [] # Read after the interaction is acknowledged
+    results = []
+    finished = 0
+    last_progress = time.monotonic()
+    start_time = time.monotonic()
+
+    async def show_progress(force: bool = False):
+        nonlocal last_progress
+        if not force and time.monotonic() - last_progress < 2:
+            return
+        last_progress = time.monotonic()
+        failed = sum(1 for result in results if result and result["error"])
+        try:
+            await interaction.edit_original_response(
+                content=f"Running {template.name} batch: {finished}/{len(batch)} done"
+                        f"{f', {failed} failed' if failed else ''} ({time.monotonic() - start_time:.0f}s)..."
+            )
+        except discord.HTTPException as e:
+            logger.warning(f"Failed to update batch progress: {e}")
+
+    async def run_prompt(index: int, prompt: str):
+        nonlocal finished
+        result = {"index": index + 1, "prompt": prompt, "model": None, "response": None, "error": None}
+        async with semaphore:
+            if drain_controller.draining:
+                result["error"] = "Skipped, the bot was restarting."
+            else:
+                usage = {}
+                call_start = time.monotonic()
+                try:
+                    if use_deepseek:
+                        response = await run_api(deepseek, prompt, sys_prompt, usage=usage)
+                    else:
+                        model = model_router.model_for(route, prompt)
+                        response = await run_api(gpt, model, prompt, sys_prompt, temperature, usage=usage)
+                    model_router.observe(route, usage.get("model"), (time.monotonic() - call_start) * 1000, ok=True)
+                    record_usage(interaction, usage, call_start)
+                    result["response"] = response or ""
+                    if not response:
+                        result["error"] = "The API returned an empty response."
+                except Exception as e:
+                    logger.warning(f"Batch prompt {index + 1} failed: {e}")
+                    model_router.observe(route, usage.get("model"), (time.monotonic() - call_start) * 1000, ok=False)
+                    result["error"] = str(e)[:300]
+                result["model"] = usage.get("model")
+        results[index] = result
+        finished += 1
+        await show_progress()
+
+    try:
+        # Acknowledge first, downloading the file can take longer than Discord's 3 second deadline
+        await interaction.response.defer(ephemeral=False, thinking=True)
+        try:
+            batch = await read_batch_prompts(prompts, separator, file)
+        except BatchInputError as e:
+            await interaction.followup.send(f"{e} Add inputs with `prompts` or upload a `file`.", ephemeral=True)
+            trace.finish(traces.REJECTED)
+            return
+        trace.prompt_chars = sum(len(prompt) for prompt in batch)
+
+        # Budget check for the whole batch (rough estimate of 4 characters per token)
+        estimated_tokens = sum(len(prompt) + len(sys_prompt) for prompt in batch) // 4
+        if await reject_over_budget(interaction, tokens=estimated_tokens):
+            trace.finish(traces.REJECTED)
+            return
+
+        results = [None] * len(batch)
+        start_time = time.monotonic()
+        await show_progress(force=True)
+        await asyncio.gather(*(run_prompt(index, prompt) for index, prompt in enumerate(batch)))
+        upstream_ms = (time.monotonic() - start_time) * 1000
+
+        failed = sum(1 for result in results if result["error"])
+        as_jsonl = bool(file and file.filename.lower().endswith(".jsonl"))
+        result_file = discord.File(
+            io.BytesIO(format_results(results, as_jsonl)),
+            filename="batch_results.jsonl" if as_jsonl else "batch_results.md",
+        )
+        summary = (f"{template.name} batch finished: {len(batch) - failed}/{len(batch)} succeeded "
+                   f"in {upstream_ms / 1000:.0f}s.")
+        try:
+            await interaction.edit_original_response(content=summary, attachments=[result_file])
+        except discord.HTTPException as e:
+            # The interaction token expires after 15 minutes, post the results in the channel instead
+            logger.warning(f"Failed to send batch results as a response, posting them in the channel: {e}")
+            result_file.reset()
+            await interaction.channel.send(content=f"{interaction.user.mention} {summary}", file=result_file)
+        logger.info(f"Batch of {len(batch)} {template.value} prompts finished with {failed} failures in {upstream_ms:.0f}ms.")
+        trace.finish(traces.OK if failed < len(batch) else traces.ERROR, upstream_ms)
+    except Exception:
+        logger.exception("Error occurred in batch command:")
+        trace.finish(traces.ERROR)
+        try:
+            await interaction.followup.send("An error occurred while processing your batch.", ephemeral=True)
+        except discord.HTTPException as http_err:
+            logger.error(f"Failed to send batch error followup: {http_err}")
+    finally:
+        drain_controller.end(interaction.id)
+
+
+# --- Helpers for DALL-E image post-processing ---
+async def post_process_image(interaction: discord.Interaction, image_url: str) -> dict | None:
+    """
+    Downloads a generated image on the event loop and re-encodes it in the process pool, so encoding never
+    blocks the event loop. Returns the smallest variant and a thumbnail (see Image_Processing.py), or None
+    if processing is disabled or fails.
+    """
+    if image_pool is None:
+        return None
+    target_bytes = upload_target(interaction.guild_id, interaction.guild.filesize_limit if interaction.guild else None)
+    loop = asyncio.get_running_loop()
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            async with session.get(image_url) as response:
+                response.raise_for_status()
+                original = await response.read()
+        result = await loop.run_in_executor(image_pool, process_image, original, IMAGE_QUALITY_PRESET, target_bytes)
+    except Exception:
+        logger.exception("Image post-processing failed, falling back to the image link:")
+        return None
+
+    variant_format, variant = min(result["variants"].items(), key=lambda item: len(item[1]["data"]))
+    result["format"] = variant_format
+    result["data"] = variant["data"]
+    logger.info("image_processed", extra={
+        "event": "image_processed",
+        "original_bytes": result["original_bytes"],
+        "output_bytes": len(variant["data"]),
+        "output_format": variant_format,
+        "output_quality": variant["quality"],
+        "thumbnail_bytes": len(result["thumbnail"]),
+        "target_bytes": target_bytes,
+        "encode_ms": result["encode_ms"],
+    })
+    return result
+
+
+def format_bytes(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
 
 
 # --- Helper Function for DALL-E Commands ---
 async def handle_dalle_command(interaction: discord.Interaction, api_func, prompt: str, **kwargs):
     """Handles common logic for DALL-E commands."""
+    request_id_var.set(interaction.id) # Tag all logs for this command (including executor threads)
+    trace = start_trace(interaction, len(prompt))
+
+    if await reject_over_budget(interaction, images=1):
+        trace.finish(traces.REJECTED)
+        return
+
+    if not await admit_job(interaction, new_job(interaction, "image", api_func, (prompt,), kwargs, "Image Generation Result")):
+        trace.finish(traces.REJECTED)
+        return
+
+    upstream_ms = None
     try:
         await interaction.response.defer(ephemeral=False, thinking=True)
 
@@ -650,20 +1478,19 @@ async def handle_dalle_command(interaction: discord.Interaction, api_func, promp
         expiry_timestamp = int(time.mktime(future_time.timetuple()))
 
         # Run the blocking API call in an executor
-        loop = asyncio.get_event_loop()
-
-        # Create a partial function that packages api_func with its arguments
         # The 'prompt' is passed as the first positional argument to api_func
         # The items in 'kwargs' (like size, quality, style) are passed as keyword arguments to api_func
-        func_call = functools.partial(api_func, prompt, **kwargs)
-
-        # Now, run the 'func_call' (which takes no arguments itself) in the executor
-        image_url = await loop.run_in_executor(None, func_call)
+        usage = {}
+        start_time = time.monotonic()
+        image_url = await run_api(drain_controller.run_job, interaction.id, api_func, prompt, usage=usage, **kwargs)
+        upstream_ms = (time.monotonic() - start_time) * 1000
+        record_usage(interaction, usage, start_time)
 
 
         if not image_url:
              logger.warning(f"DALL-E call {api_func.__name__} returned empty URL for prompt: {prompt}")
              await interaction.followup.send("The image generation failed or returned no URL.", ephemeral=True)
+             trace.finish(traces.EMPTY, upstream_ms)
              return
 
         # Create embed for better presentation
@@ -672,7 +1499,6 @@ async def handle_dalle_command(interaction: discord.Interaction, api_func, promp
             description=f"**Prompt:** {discord.utils.escape_markdown(prompt)}\n\n[Image Link]({image_url}) (Link expires <t:{expiry_timestamp}:R>)", # Escape prompt
             color=discord.Color.purple() # Or another suitable color
         )
-        embed.set_image(url=image_url)
         avatar_url = client.user.avatar.url if client.user.avatar else None
         embed.set_author(
             name=client.user.name,
@@ -680,13 +1506,28 @@ async def handle_dalle_command(interaction: discord.Interaction, api_func, promp
         )
         # Use __name__ which should be 'dalle3' or 'dalle2'
         model_name = api_func.__name__.replace('dalle', 'DALL·E ').capitalize()
-        embed.set_footer(text=f"Generated with {model_name}") # Indicate model used
+        footer = f"Generated with {model_name}" # Indicate model used
         embed.timestamp = datetime.now()
 
-        await interaction.followup.send(embed=embed)
+        # Upload a size-optimized copy with a thumbnail for the embed, or fall back to the (expiring) image link
+        processed = await post_process_image(interaction, image_url)
+        if processed:
+            image_file = discord.File(io.BytesIO(processed["data"]), filename=f"image.{processed['format']}")
+            thumbnail_file = discord.File(io.BytesIO(processed["thumbnail"]), filename="thumbnail.webp")
+            embed.set_thumbnail(url="attachment://thumbnail.webp") # The full image is the uploaded file
+            footer += (f" · {processed['format'].upper()} {format_bytes(len(processed['data']))}"
+                       f" (from {format_bytes(processed['original_bytes'])} {processed['original_format']}) in {processed['encode_ms']}ms")
+            embed.set_footer(text=footer)
+            await interaction.followup.send(embed=embed, files=[image_file, thumbnail_file])
+        else:
+            embed.set_image(url=image_url)
+            embed.set_footer(text=footer)
+            await interaction.followup.send(embed=embed)
+        trace.finish(traces.OK, upstream_ms)
 
     except Exception as e:
         logger.exception(f"Error occurred in DALL-E command '{api_func.__name__}':")
+        trace.finish(traces.ERROR, upstream_ms)
         error_message_user = "An error occurred while generating the image."
         # Check for specific OpenAI content policy violation format
         if "content_policy_violation" in str(e):
@@ -697,7 +1538,7 @@ async def handle_dalle_command(interaction: discord.Interaction, api_func, promp
                  error_message_user = "Your prompt was flagged due to content policy."
         elif "Invalid size" in str(e): # Example for specific API errors
              error_message_user = "An invalid image size was provided for the selected DALL-E model."
-        elif "Rate limit" in str(e): # Example for rate limits
+        elif isinstance(e, (openai.RateLimitError, RateLimitExceeded)): # Every pooled key is rate limited
              error_message_user = "Rate limit reached. Please try again later."
 
         try:
@@ -706,6 +1547,8 @@ async def handle_dalle_command(interaction: discord.Interaction, api_func, promp
              logger.error("Interaction expired before DALL-E error message could be sent.")
         except discord.HTTPException as http_err:
              logger.error(f"Failed to send DALL-E error followup: {http_err}")
+    finally:
+        drain_controller.end(interaction.id)
 
 
 # -------------------------- DALLE 3 ----------------------------------
@@ -753,6 +1596,103 @@ async def dalle_2_command(interaction: discord.Interaction, prompt: str, size: a
     await handle_dalle_command(interaction, dalle2, prompt, size=size.value)
 
 
+# -------------------------- USAGE ----------------------------------
+@client.tree.command(name="usage", description="Shows token and image usage for you or this server")
+@app_commands.describe(scope="Whose usage to show")
+@app_commands.choices(scope=[
+    app_commands.Choice(name="Me", value="me"),
+    app_commands.Choice(name="This Server", value="server"),
+])
+async def usage_command(interaction: discord.Interaction, scope: app_commands.Choice[str] = None):
+    trace = start_trace(interaction)
+    scope_value = scope.value if scope else "me"
+    if scope_value == "server" and not interaction.guild_id:
+        await interaction.response.send_message("Server usage is only available inside a server.", ephemeral=True)
+        return
+
+    if scope_value == "server":
+        key, budget_kind, title = f"g:{interaction.guild_id}", "g", f"Usage for {interaction.guild.name if interaction.guild else 'this server'}"
+    else:
+        key, budget_kind, title = f"u:{interaction.user.id}", "u", f"Usage for {interaction.user.display_name}"
+
+    # Reads pre-aggregated counters only, no ledger scan
+    current = usage_ledger.get_current(key)
+    embed = discord.Embed(title=title, color=discord.Color.blue())
+    for period, label in (("day", "Today (UTC)"), ("month", "This Month (UTC)")):
+        tokens, images, requests_count, latency_ms = current[period]
+        token_budget = BUDGETS[(budget_kind, period, "tokens")]
+        image_budget = BUDGETS[(budget_kind, period, "images")]
+        avg_latency = round(latency_ms / requests_count) if requests_count else 0
+        embed.add_field(
+            name=label,
+            value=(
+                f"Tokens: {tokens:,}" + (f" / {token_budget:,}" if token_budget else "") + "\n"
+                f"Images: {images:,}" + (f" / {image_budget:,}" if image_budget else "") + "\n"
+                f"Requests: {requests_count:,}\n"
+                f"Avg latency: {avg_latency:,}ms"
+            ),
+            inline=True,
+        )
+
+    if scope_value == "server":
+        top = usage_ledger.top_commands(interaction.guild_id)
+        if top:
+            embed.add_field(
+                name="Top Commands This Month",
+                value="\n".join(f"/{name}: {counter[0]:,} tokens, {counter[1]:,} images, {counter[2]:,} requests" for name, counter in top),
+                inline=False,
+            )
+    embed.timestamp = datetime.now()
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+    trace.finish(traces.LOCAL)
+
+
+# -------------------------- CACHE STATS ----------------------------------
+@client.tree.command(name="cache_stats", description="Shows cache hit rates (Owner only)")
+async def cache_stats(interaction: discord.Interaction):
+    if interaction.user.id != owner_uid:
+        await interaction.response.send_message("You don't have permission to view cache stats.", ephemeral=True)
+        return
+
+    stats = semantic_cache.stats()
+    emoji_lookups = emoji_index.hits + emoji_index.misses
+    emoji_hit_rate = round(emoji_index.hits / emoji_lookups, 3) if emoji_lookups else 0.0
+    embed = discord.Embed(title="Cache Stats", color=discord.Color.blue())
+    embed.add_field(
+        name="Semantic Cache (/ask_gpt, /ask_deepseek)",
+        value=(
+            f"Hit rate: {stats['hit_rate']:.1%} ({stats['hits']:,} hits, {stats['misses']:,} misses)\n"
+            f"Entries: {stats['entries']:,} in {stats['scopes']:,} scopes\n"
+            f"Evictions: {stats['evictions']:,}\n"
+            f"Memory: {stats['memory_bytes'] / (1024 * 1024):.1f} of {stats['max_bytes'] / (1024 * 1024):.0f} MB"
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="Emoji Index (/gpt_text_to_emoji)",
+        value=(
+            f"Hit rate: {emoji_hit_rate:.1%} ({emoji_index.hits:,} hits, {emoji_index.misses:,} misses)\n"
+            f"Words: {len(emoji_index.seed):,} seed, {len(emoji_index.learned):,} learned"
+        ),
+        inline=False,
+    )
+    for name, pool in (("OpenAI", openai_key_pool), ("OpenRouter", openrouter_key_pool)):
+        pool_stats = pool.stats()
+        key_lines = [
+            f"`{key['key']}`: {key['requests']:,} requests, {key['rate_limited']:,} rate limited"
+            + (", sidelined" if key["sidelined"] else "")
+            for key in pool_stats["keys"]
+        ]
+        embed.add_field(
+            name=f"{name} API Keys",
+            value="\n".join([
+                f"In flight: {pool_stats['in_flight']} (limit {pool_stats['concurrency_limit']:g})"
+            ] + key_lines[:10]),
+            inline=False,
+        )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
 # --- Main Execution ---
 if __name__ == "__main__":
     if not token:
@@ -774,4 +1714,9 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception("An unexpected error occurred during bot execution:")
         sys.exit("Critical Error: Bot failed to run.")
+    finally:
+        flush_state()
+        if image_pool is not None:
+            image_pool.shutdown(cancel_futures=True)
+        shutdown_logging() # Flush queued log records last
 
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import Bulk_Delete
+from Bulk_Delete import bulk_delete, BULK_DELETE_MAX_AGE
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeMessage:
+    def __init__(self, channel, message_id, created_at):
+        self.channel = channel
+        self.id = message_id
+        self.created_at = created_at
+
+    async def delete(self):
+        self.channel.single_deleted.append(self.id)
+
+
+class FakeChannel:
+    def __init__(self, ages, scan_seconds=0):
+        self.messages = [FakeMessage(self, number, START - age) for number, age in enumerate(ages)]
+        self.scan_seconds = scan_seconds
+        self.bulk_deleted = []
+        self.single_deleted = []
+        self.now = START
+
+    async def history(self, **kwargs):
+        for message in self.messages:
+            yield message
+            self.now += timedelta(seconds=self.scan_seconds)
+
+    async def delete_messages(self, messages):
+        self.bulk_deleted.extend(message.id for message in messages)
+
+
+def run_delete(monkeypatch, channel, limit=100):
+    monkeypatch.setattr(Bulk_Delete, "SINGLE_DELETE_INTERVAL", 0)
+    monkeypatch.setattr(Bulk_Delete.discord.utils, "utcnow", lambda: channel.now)
+    return asyncio.run(bulk_delete(channel, limit))
+
+
+def test_young_messages_are_bulk_deleted_and_old_ones_singly(monkeypatch):
+    channel = FakeChannel([timedelta(hours=1), timedelta(days=1), timedelta(days=20)])
+    progress = run_delete(monkeypatch, channel)
+    assert channel.bulk_deleted == [0, 1]
+    assert channel.single_deleted == [2]
+    assert progress.deleted == 3
+
+
+def test_messages_aging_out_while_batched_are_deleted_singly(monkeypatch):
+    # The second message is 30 seconds from the bulk delete limit when scanned, but scanning takes a minute each
+    channel = FakeChannel([timedelta(hours=1), BULK_DELETE_MAX_AGE - timedelta(seconds=90)], scan_seconds=60)
+    progress = run_delete(monkeypatch, channel)
+    assert channel.bulk_deleted == [0]
+    assert channel.single_deleted == [1]
+    assert progress.bulk_deleted == 1
+    assert progress.single_deleted == 1
@@ -0,0 +1,68 @@
+import math
+
+import pytest
+
+from Code_Chunker import chunk_code, CHARS_PER_TOKEN
+
+
+def python_file(functions: int, lines_per_function: int) -> str:
+    body = "".join(f"    value_{j} = compute({j}) * 2  # padding to make the line longer\n" for j in range(lines_per_function))
+    return "import os\n\n" + "".join(f"def function_{i}():\n{body}\n\n" for i in range(functions))
+
+
+def assert_covers(text: str, chunks: list, max_tokens: int):
+    """Every line is in exactly one chunk, in order, with correct line numbers, and chunks respect the limit."""
+    assert "".join(chunk.text for chunk in chunks) == text
+    lines = text.splitlines(keepends=True)
+    next_line = 1
+    for chunk in chunks:
+        assert len(chunk.text) <= max_tokens * CHARS_PER_TOKEN
+        assert chunk.start_line in (next_line, next_line - 1) # A cut long line can continue in the next chunk
+        assert chunk.text in "".join(lines[chunk.start_line - 1:chunk.end_line])
+        next_line = chunk.end_line + 1
+    assert chunks[-1].end_line == len(lines)
+
+
+@pytest.mark.parametrize("filename", ["example.py", "example.txt"])
+def test_small_file_is_one_chunk(filename):
+    text = python_file(3, 3)
+    chunks = chunk_code(text, filename)
+    assert len(chunks) == 1
+    assert (chunks[0].start_line, chunks[0].end_line) == (1, len(text.splitlines()))
+
+
+def test_definitions_are_kept_together():
+    text = python_file(6, 10)
+    chunks = chunk_code(text, "example.py", max_tokens=400)
+    assert_covers(text, chunks, 400)
+    assert len(chunks) > 1
+    for chunk in chunks[1:]:
+        assert chunk.text.startswith("def ")
+
+
+def test_oversized_definitions_do_not_leave_tiny_chunks():
+    text = python_file(10, 30) # About 2 KB per function, four times the chunk size
+    max_tokens = 500
+    chunks = chunk_code(text, "example.py", max_tokens=max_tokens)
+    assert_covers(text, chunks, max_tokens)
+    assert len(chunks) == math.ceil(len(text) / (max_tokens * CHARS_PER_TOKEN))
+    assert all(len(chunk.text) > max_tokens * CHARS_PER_TOKEN / 2 for chunk in chunks[:-1])
+
+
+def test_long_lines_are_cut():
+    text = "x = '" + "a" * 5000 + "'\nprint(x)\n"
+    chunks = chunk_code(text, "example.py", max_tokens=200)
+    assert_covers(text, chunks, 200)
+    assert chunks[0].start_line == chunks[1].start_line == 1
+
+
+def test_heuristic_boundaries_for_other_languages():
+    function = "function f() {\n" + "  doSomething();\n" * 40 + "}\n"
+    text = function * 4
+    chunks = chunk_code(text, "example.js", max_tokens=250)
+    assert_covers(text, chunks, 250)
+    assert all(chunk.text.startswith("function") for chunk in chunks)
+
+
+def test_empty_file():
+    assert chunk_code("", "example.py") == []
@@ -0,0 +1,50 @@
+import Emoji_Index
+from Emoji_Index import EmojiIndex
+
+
+def make_index(tmp_path, max_words=10):
+    return EmojiIndex(seed_path=str(tmp_path / "missing_seed.json"), index_path=str(tmp_path / "index.tsv"),
+                      max_words=max_words, min_votes=2)
+
+
+def learn_at(monkeypatch, index, when, text, response):
+    monkeypatch.setattr(Emoji_Index.time, "time", lambda: when)
+    index.learn(text, response)
+
+
+def test_new_words_replace_stale_unconfirmed_words(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    for number in range(10):
+        learn_at(monkeypatch, index, 100, f"word{number}", "🙂")
+    learn_at(monkeypatch, index, 200, "fresh", "🆕")
+    assert "fresh" in index.learned
+    assert len(index.learned) == 9
+
+
+def test_confirmed_words_outlive_newer_unconfirmed_words(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    learn_at(monkeypatch, index, 100, "cat", "🐱")
+    learn_at(monkeypatch, index, 100, "cat", "🐱")
+    for number in range(10):
+        learn_at(monkeypatch, index, 200 + number, f"word{number}", "🙂")
+    assert index.learned["cat"][:2] == ["🐱", 2]
+    assert "word9" in index.learned
+    assert "word0" not in index.learned
+
+
+def test_lookups_refresh_last_seen(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    learn_at(monkeypatch, index, 100, "cat", "🐱")
+    learn_at(monkeypatch, index, 100, "cat", "🐱")
+    monkeypatch.setattr(Emoji_Index.time, "time", lambda: 300)
+    assert index.lookup("Cat!") == "🐱"
+    assert index.learned["cat"][2] == 300
+
+
+def test_save_and_load_keep_last_seen(tmp_path, monkeypatch):
+    (tmp_path / "index.tsv").write_text("old\t👴\t3\n", encoding="utf-8")
+    index = make_index(tmp_path)
+    assert index.learned["old"][:2] == ["👴", 3]
+    learn_at(monkeypatch, index, 100, "dog", "🐶")
+    index.save()
+    assert make_index(tmp_path).learned["dog"] == ["🐶", 1, 100]
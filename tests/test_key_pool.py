@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from Key_Pool import KeyPool, RateLimitExceeded, parse_duration, DEFAULT_SIDELINE_SECONDS, QUOTA_SIDELINE_SECONDS
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("20ms", 0.02),
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("1h2m3.5s", 3723.5),
+    ("7", 7.0),
+    ("soon", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == (pytest.approx(expected) if expected is not None else None)
+
+
+def test_openai_headers_update_the_key():
+    pool = KeyPool("openai", ["sk-one"])
+    with pool.lease(tokens=100) as lease:
+        lease.update({"x-ratelimit-remaining-requests": "5", "x-ratelimit-remaining-tokens": "900",
+                      "x-ratelimit-reset-requests": "2s", "x-ratelimit-reset-tokens": "30s"})
+    state = pool.keys[0]
+    assert (state.remaining_requests, state.remaining_tokens) == (5, 900)
+    assert state.reset_at - time.monotonic() == pytest.approx(30, abs=1)
+
+
+def test_lease_prefers_the_key_with_most_headroom():
+    pool = KeyPool("openai", ["sk-one", "sk-two"])
+    with pool.lease() as lease:
+        lease.update({"x-ratelimit-remaining-requests": "1", "x-ratelimit-reset-requests": "60s"})
+        first = lease.key
+    with pool.lease() as lease:
+        assert lease.key != first
+
+
+def test_exhausted_keys_are_skipped_until_reset():
+    pool = KeyPool("openai", ["sk-one"])
+    with pool.lease() as lease:
+        lease.update({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "60s"})
+    with pytest.raises(RateLimitExceeded):
+        with pool.lease(timeout=0.05):
+            pass
+
+
+@pytest.mark.parametrize("provider, headers, quota, expected", [
+    ("openai", {"retry-after": "5"}, False, 5),
+    ("openai", {"x-ratelimit-reset-requests": "12s"}, False, 12),
+    ("openai", {}, False, DEFAULT_SIDELINE_SECONDS),
+    ("openai", {"retry-after": "5"}, True, QUOTA_SIDELINE_SECONDS),
+    ("openrouter", {"x-ratelimit-reset": str(int((time.time() + 40) * 1000))}, False, 40),
+])
+def test_rate_limited_keys_are_sidelined_until_reset(provider, headers, quota, expected):
+    pool = KeyPool(provider, ["sk-one"], reset_headers=provider)
+    with pool.lease() as lease:
+        lease.rate_limited(headers, quota=quota)
+    state = pool.keys[0]
+    assert state.rate_limited == 1
+    assert state.sidelined_until - time.monotonic() == pytest.approx(expected, abs=1)
+    assert pool.stats()["keys"][0]["sidelined"]
+
+
+def test_aimd_limit():
+    pool = KeyPool("openai", ["sk-one"], concurrency_per_key=8)
+    assert pool.limit == 8
+    with pool.lease() as lease:
+        lease.rate_limited({"retry-after": "0"})
+    assert pool.limit == 4 # Halved on a 429
+    with pool.lease() as lease:
+        lease.update({})
+    assert pool.limit == pytest.approx(4.25) # Raised by 1 / limit on a success
+    for _ in range(200):
+        with pool.lease() as lease:
+            lease.update({})
+    assert pool.limit == 8 # Never above the configured maximum
+    assert pool.stats()["in_flight"] == 0
+
+
+def test_concurrency_limit_blocks_extra_leases():
+    pool = KeyPool("openai", ["sk-one"], concurrency_per_key=1)
+    with pool.lease():
+        with pytest.raises(RateLimitExceeded):
+            with pool.lease(timeout=0.05):
+                pass
+
+
+def test_no_keys():
+    with pytest.raises(RateLimitExceeded):
+        with KeyPool("openai", []).lease():
+            pass
@@ -0,0 +1,17 @@
+from Model_Router import ModelRouter, STRONG_MODEL, FAST_MODEL
+
+COMPLEX_PROMPT = "Why is the sky blue? Why is grass green?"
+
+
+def test_slow_commands_do_not_slow_down_auto_routing():
+    router = ModelRouter()
+    for _ in range(20):
+        router.observe("gpt_short_story", STRONG_MODEL, 60000, ok=True)
+    assert router.model_for("ask_gpt", COMPLEX_PROMPT) == STRONG_MODEL
+
+
+def test_auto_routing_avoids_a_slow_strong_model():
+    router = ModelRouter()
+    for _ in range(20):
+        router.observe("ask_gpt", STRONG_MODEL, 60000, ok=True)
+    assert router.model_for("ask_gpt", COMPLEX_PROMPT) == FAST_MODEL
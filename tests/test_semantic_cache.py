@@ -0,0 +1,90 @@
+import pytest
+
+from Semantic_Cache import SemanticCache, content_matches
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("what is the capital of austria", "what is the capital of australia"),
+    ("population of china", "population of chile"),
+    ("convert celsius to fahrenheit", "convert fahrenheit to celsius"),
+    ("is python fast", "is python not fast"),
+])
+def test_different_questions_are_not_served(cached, asked):
+    cache = SemanticCache()
+    cache.put("g1:ask_gpt", cached, "cached answer")
+    assert cache.get("g1:ask_gpt", asked) is None
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("what is rust", "What's Rust?"),
+    ("what is the capital of austria", "What's the capital of Austria?"),
+])
+def test_rephrased_questions_are_served(cached, asked):
+    cache = SemanticCache()
+    cache.put("g1:ask_gpt", cached, "cached answer")
+    response, similarity = cache.get("g1:ask_gpt", asked)
+    assert response == "cached answer"
+    assert similarity >= cache.threshold
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("what's the weather like in paris", "what is the weather in paris"),
+    ("best pizza toppings", "what are the best pizza toppings"),
+])
+def test_one_extra_word_is_left_to_the_threshold(cached, asked):
+    cache = SemanticCache(threshold=0.7)
+    cache.put("g1:ask_gpt", cached, "cached answer")
+    response, similarity = cache.get("g1:ask_gpt", asked)
+    assert response == "cached answer"
+
+    strict = SemanticCache(threshold=0.99)
+    strict.put("g1:ask_gpt", cached, "cached answer")
+    assert strict.get("g1:ask_gpt", asked) is None
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("what is the capital of austria", "what is the capital of australia"),
+    ("convert celsius to fahrenheit", "convert fahrenheit to celsius"),
+    ("is python fast", "is python not fast"),
+])
+def test_content_guard_holds_at_any_threshold(cached, asked):
+    cache = SemanticCache(threshold=0.5)
+    cache.put("g1:ask_gpt", cached, "cached answer")
+    assert cache.get("g1:ask_gpt", asked) is None
+
+
+@pytest.mark.parametrize("a, b, expected", [
+    (("weather", "paris"), ("weather", "like", "paris"), True),
+    (("capital", "austria"), ("capital", "australia"), False),
+    (("convert", "celsius", "fahrenheit"), ("convert", "fahrenheit", "celsius"), False),
+    (("python", "fast"), ("python", "not", "fast"), False),
+    (("best", "pizza"), ("what", "best", "pizza", "toppings"), False),
+])
+def test_content_matches(a, b, expected):
+    assert content_matches(a, b) is expected
+    assert content_matches(b, a) is expected
+
+
+def test_scopes_are_separate():
+    cache = SemanticCache()
+    cache.put("g1:ask_gpt", "what is rust", "cached answer")
+    assert cache.get("g2:ask_gpt", "what is rust") is None
+
+
+def test_memory_cap_holds_with_many_scopes():
+    cache = SemanticCache(max_bytes=2 * 1024 * 1024)
+    for i in range(3000): # One entry per DM scope, the worst case for per-scope storage
+        cache.put(f"dm{i}:ask_gpt", f"question number {i}", "x" * 10000)
+    stats = cache.stats()
+    assert stats["memory_bytes"] <= cache.max_bytes
+    assert stats["scopes"] == stats["entries"] > 0
+    # The newest entries survive, the least recently used were evicted
+    assert cache.get("dm2999:ask_gpt", "question number 2999") is not None
+    assert cache.get("dm0:ask_gpt", "question number 0") is None
+
+
+def test_answers_are_capped():
+    cache = SemanticCache()
+    cache.put("g1:ask_gpt", "what is rust", "x" * 10000)
+    response, _ = cache.get("g1:ask_gpt", "what is rust")
+    assert len(response) == 4096
@@ -0,0 +1,95 @@
+import builtins
+import json
+import time
+
+import Usage_Ledger
+from Usage_Ledger import UsageLedger, REQUESTS, TOKENS
+
+
+def open_ledger(tmp_path):
+    return UsageLedger(ledger_path=str(tmp_path / "ledger.jsonl"), rollup_path=str(tmp_path / "rollups.json"),
+                       flush_seconds=3600)
+
+
+def user_counter(ledger, user_id=1):
+    return ledger.get_current(f"u:{user_id}")["day"]
+
+
+def test_entries_after_the_snapshot_are_replayed(tmp_path):
+    ledger = open_ledger(tmp_path)
+    ledger.record(1, 10, "ask_gpt", "gpt-4", prompt_tokens=100, completion_tokens=50)
+    ledger.close()
+
+    # An entry appended after the last snapshot, e.g. by a process that crashed before snapshotting again
+    entry = json.loads((tmp_path / "ledger.jsonl").read_text().splitlines()[0])
+    with open(tmp_path / "ledger.jsonl", "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+    reopened = open_ledger(tmp_path)
+    assert user_counter(reopened)[REQUESTS] == 2
+    assert user_counter(reopened)[TOKENS] == 300
+    reopened.close()
+
+
+def test_reopening_does_not_double_count(tmp_path):
+    ledger = open_ledger(tmp_path)
+    for _ in range(3):
+        ledger.record(1, None, "ask_gpt", "gpt-4", prompt_tokens=10)
+    ledger.close()
+    for _ in range(2):
+        reopened = open_ledger(tmp_path)
+        assert user_counter(reopened)[REQUESTS] == 3
+        reopened.close()
+
+
+def test_snapshot_skips_entries_it_already_counted(tmp_path):
+    ledger = open_ledger(tmp_path)
+    ledger.record(1, None, "ask_gpt", "gpt-4", prompt_tokens=10)
+    ledger.close()
+    snapshot = json.loads((tmp_path / "rollups.json").read_text())
+    line = (tmp_path / "ledger.jsonl").read_text()
+
+    # Snapshot taken after the entry was counted but before the writer appended it
+    snapshot["ledger_offset"], snapshot["ledger_skip"] = 0, 1
+    (tmp_path / "rollups.json").write_text(json.dumps(snapshot))
+    (tmp_path / "ledger.jsonl").write_text(line * 2)
+
+    reopened = open_ledger(tmp_path)
+    assert user_counter(reopened)[REQUESTS] == 2
+    reopened.close()
+
+
+def test_old_snapshots_are_rebuilt_from_the_ledger(tmp_path):
+    ledger = open_ledger(tmp_path)
+    ledger.record(1, None, "ask_gpt", "gpt-4", prompt_tokens=10)
+    ledger.close()
+    snapshot = json.loads((tmp_path / "rollups.json").read_text())
+    (tmp_path / "rollups.json").write_text(json.dumps(snapshot["rollups"]))
+
+    reopened = open_ledger(tmp_path)
+    assert user_counter(reopened)[REQUESTS] == 1
+    reopened.close()
+
+
+def test_failed_appends_are_not_skipped_on_replay(tmp_path, monkeypatch):
+    ledger = open_ledger(tmp_path)
+
+    def failing_open(path, mode="r", *args, **kwargs):
+        if mode == "ab":
+            raise OSError("No space left on device")
+        return builtins.open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(Usage_Ledger, "open", failing_open, raising=False)
+    ledger.record(1, 10, "ask_gpt", "gpt-4", prompt_tokens=100, completion_tokens=50)
+    ledger.close()
+    monkeypatch.undo()
+    assert json.loads((tmp_path / "rollups.json").read_text())["ledger_skip"] == 0
+
+    # The disk has room again and another process appends an entry after the snapshot
+    entry = [time.time(), 1, 10, "ask_gpt", "gpt-4", 100, 50, 0, 0]
+    with open(tmp_path / "ledger.jsonl", "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+    reopened = open_ledger(tmp_path)
+    assert user_counter(reopened)[REQUESTS] == 2
+    reopened.close()